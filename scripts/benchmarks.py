@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+
+"""Micro-benchmarks of the migration steps on synthetic data."""
+
+from __future__ import absolute_import, print_function
+
+import json
+import time
+from copy import deepcopy
+from functools import partial
+from os.path import dirname, join
+
+import click
+
+MARCXML_TEMPLATE = (
+    u'<record>\n'
+    u'  <controlfield tag="001">{recid}</controlfield>\n'
+    u'{datafields}'
+    u'</record>\n'
+)
+
+DATAFIELD_TEMPLATE = (
+    u'  <datafield tag="{tag}" ind1=" " ind2=" ">\n'
+    u'    <subfield code="a">Value {idx} of the field {tag}</subfield>\n'
+    u'  </datafield>\n'
+)
+
+
+def synthetic_dump(records, revisions, datafields=50):
+    """Generate a legacy records dump."""
+    tags = ['100', '245', '347', '520', '700', '856']
+    data = []
+    for recid in range(1, records + 1):
+        marcxml = MARCXML_TEMPLATE.format(recid=recid, datafields=u''.join(
+            DATAFIELD_TEMPLATE.format(tag=tags[i % len(tags)], idx=i)
+            for i in range(datafields)))
+        data.append({
+            'record': [{
+                'json': {
+                    'recid': recid,
+                    'title': 'Record {0}'.format(recid),
+                    'access_right': 'open',
+                    'owner': {'id': 1, 'email': 'info@zenodo.org'},
+                    'fft': [{'url': '/tmp/file.pdf'}],
+                },
+                'marcxml': marcxml,
+            } for _ in range(revisions)],
+            '_files': [{'key': 'file.pdf'}],
+        })
+    return data
+
+
+def timeit(func, *args, **kwargs):
+    """Return the execution time of a function call in seconds."""
+    start = time.time()
+    func(*args, **kwargs)
+    return time.time() - start
+
+
+@click.group()
+def cmd():
+    """Benchmarks of the migration steps."""
+    pass
+
+
+@cmd.command()
+@click.option('--records', '-n', default=2000)
+@click.option('--revisions', '-r', default=3)
+@click.option('--jobs', '-j', 'jobs', multiple=True, type=int,
+              default=[1, 2, 4, 8])
+def cleandump(records, revisions, jobs):
+    """Benchmark the dump cleaning with different numbers of processes."""
+    from zenodo_migrator.cleaner import clean_record
+    from zenodo_migrator.utils import parallel_imap
+
+    data = synthetic_dump(records, revisions)
+    clean = partial(clean_record, drop_marcxml=False)
+    baseline = None
+    for n in jobs:
+        dump = deepcopy(data)
+        t = timeit(lambda: list(parallel_imap(clean, dump, jobs=n)))
+        baseline = baseline or t
+        click.echo('{0:>3} job(s): {1:8.2f}s {2:8.1f} records/s '
+                   '(speedup {3:.2f}x)'.format(
+                       n, t, records / t, baseline / t))
+
+
+def legacy_clean_marcxml(marcxml):
+    """Clean MARCXML the way ``cleandump`` used to (for comparison)."""
+    from lxml import etree
+    from six import StringIO
+
+    parser = etree.XMLParser(encoding='utf-8')
+    tree = etree.parse(StringIO(marcxml), parser)
+    for e in tree.xpath('/record/datafield[@tag=856 or @tag=347]'):
+        e.getparent().remove(e)
+    return etree.tostring(tree, pretty_print=True).decode('utf-8')
+
+
+@cmd.command()
+@click.option('--records', '-n', default=100)
+@click.option('--revisions', '-r', default=50)
+@click.option('--datafields', '-f', default=50)
+def marcxml(records, revisions, datafields):
+    """Benchmark the per-revision cost of the MARCXML cleaning."""
+    from zenodo_migrator.cleaner import MARCXMLCleaner
+
+    data = synthetic_dump(records, revisions, datafields=datafields)
+    documents = [rev['marcxml'] for d in data for rev in d['record']]
+    for name, clean in [('legacy', legacy_clean_marcxml),
+                        ('MARCXMLCleaner', MARCXMLCleaner())]:
+        t = timeit(lambda: [clean(doc) for doc in documents])
+        click.echo('{0:>15}: {1:8.1f}us/revision ({2} revisions)'.format(
+            name, t * 1e6 / len(documents), len(documents)))
+
+
+@cmd.command()
+@click.option('--records', '-n', default=1000)
+@click.option('--creators', '-c', default=10)
+def validation(records, creators):
+    """Benchmark the JSON Schema validation of migrated records."""
+    from flask import Flask
+    from invenio_jsonschemas import InvenioJSONSchemas
+    from invenio_records import InvenioRecords
+    from invenio_records.api import Record
+    from zenodo_migrator.records import MigrationRecord
+
+    app = Flask(__name__)
+    app.config.update(JSONSCHEMAS_HOST='zenodo.org')
+    InvenioRecords(app)
+    InvenioJSONSchemas(app)
+    data = {
+        '$schema': 'https://zenodo.org/schemas/records/record-v1.0.0.json',
+        'recid': 1,
+        'title': 'Test record',
+        'description': 'Test description',
+        'publication_date': '2017-01-01',
+        'access_right': 'open',
+        'resource_type': {'type': 'publication', 'subtype': 'article'},
+        'creators': [{'name': 'Doe, John', 'affiliation': 'CERN'}] * creators,
+        'keywords': ['migration', 'benchmark'],
+    }
+    with app.app_context():
+        for record_cls in (Record, MigrationRecord):
+            record = record_cls(data)
+            t = timeit(lambda: [record.validate() for _ in range(records)])
+            click.echo('{0:>15}: {1:8.1f} validations/s'.format(
+                record_cls.__name__, records / t))
+
+
+DATA_DIR = join(dirname(__file__), '..', 'tests', 'data')
+
+
+def scaled_deposits(creators):
+    """Load the test legacy deposits, scaled up to large deposits.
+
+    The draft values of every deposit are given ``creators`` creators and
+    are used as its ``_n`` data (with None values to normalize).
+    """
+    deposits = []
+    for i in range(1, 8):
+        with open(join(DATA_DIR, 'dep{0}_in.json'.format(i))) as fp:
+            dep = json.load(fp)
+        drafts = list(dep['drafts'].values())
+        if drafts:
+            drafts[0]['values']['creators'] = [
+                {'name': 'Doe, John {0}'.format(j), 'affiliation': 'CERN',
+                 'orcid': '', 'gnd': ''} for j in range(creators)]
+        dep['_n'] = deepcopy(drafts[0]['values']) if drafts else {}
+        dep['_n']['_deposit'] = {'id': i, 'status': 'draft'}
+        dep['_n']['creators'] = [
+            {'name': 'Doe, John {0}'.format(j), 'affiliation': None,
+             'orcid': None, 'gnd': None} for j in range(creators)]
+        deposits.append(dep)
+    return deposits
+
+
+def legacy_normalize_deposit(d):
+    """Normalize a deposit the way ``transform_deposit`` used to."""
+    def empty_if_none(d):
+        if isinstance(d, dict):
+            return dict((k, empty_if_none(v)) for k, v in d.items())
+        elif isinstance(d, list):
+            return list(empty_if_none(i) for i in d)
+        else:
+            return "" if d is None else d
+
+    d['_n'] = empty_if_none(d['_n'])
+    d['_n'].setdefault('$schema', 'deposit-v1.0.0.json')
+    data = deepcopy(d['_n'])
+    d.clear()
+    d.update(data)
+    return d
+
+
+@cmd.command()
+@click.option('--repeat', '-n', default=100)
+@click.option('--creators', '-c', default=500)
+def deposits(repeat, creators):
+    """Benchmark the normalization of (large) legacy deposits."""
+    from flask import Flask
+    from invenio_jsonschemas import InvenioJSONSchemas
+    from zenodo_migrator.deposit import _finalize, _fix_none_values
+
+    app = Flask(__name__)
+    app.config.update(
+        JSONSCHEMAS_HOST='zenodo.org',
+        DEPOSIT_DEFAULT_JSONSCHEMA='deposits/deposit-v1.0.0.json')
+    InvenioJSONSchemas(app)
+    data = scaled_deposits(creators)
+    with app.app_context():
+        for name, normalize in [
+                ('legacy', legacy_normalize_deposit),
+                ('in place', lambda d: _finalize(_fix_none_values(d)))]:
+            dumps = [deepcopy(data) for _ in range(repeat)]
+            t = timeit(lambda: [normalize(d) for ds in dumps for d in ds])
+            click.echo('{0:>15}: {1:8.1f} deposits/s ({2} creators)'.format(
+                name, repeat * len(data) / t, creators))
+
+
+@cmd.command()
+@click.option('--repeat', '-n', default=20)
+@click.option('--creators', '-c', default=10)
+def translator(repeat, creators):
+    """Benchmark the deposit transformation with the legacy translators.
+
+    Needs a configured Zenodo instance.
+    """
+    from zenodo.factory import create_app
+    from zenodo.modules.deposit.loaders.base import marshmallow_loader
+    from zenodo_migrator import deposit
+    from zenodo_migrator.loaders import DumpLegacyRecordSchemaV1, \
+        legacyjsondump_v1_translator
+
+    data = [d for d in scaled_deposits(creators) if d['drafts']]
+    for d in data:
+        d['_n']['_deposit']['pid'] = {
+            'type': 'recid', 'value': d['_n']['_deposit']['id']}
+    results = []
+    with create_app().app_context():
+        for name, translate in [
+                ('loader', marshmallow_loader(
+                    DumpLegacyRecordSchemaV1, banned_prefixes=())),
+                ('cached schema', legacyjsondump_v1_translator)]:
+            deposit.legacyjsondump_v1_translator = translate
+            dumps = [deepcopy(data) for _ in range(repeat)]
+            t = timeit(lambda: [deposit.transform_deposit(d)
+                                for ds in dumps for d in ds])
+            results.append(dumps[0])
+            click.echo('{0:>15}: {1:8.1f} deposits/s ({2} creators)'.format(
+                name, repeat * len(data) / t, creators))
+    deposit.legacyjsondump_v1_translator = legacyjsondump_v1_translator
+    assert results[0] == results[1]
+
+
+if __name__ == '__main__':
+    cmd()
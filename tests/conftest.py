@@ -56,6 +56,7 @@ from sqlalchemy_utils.functions import create_database, database_exists
 from zenodo import config as c
 
 from zenodo_migrator import ZenodoMigrator
+from zenodo_migrator.transform import community_cache
 
 
 @pytest.yield_fixture(scope='session')
@@ -151,6 +152,12 @@ def db(app):
     db_.drop_all()
 
 
+@pytest.fixture(autouse=True)
+def clear_community_cache():
+    """Clear the community cache, as the database is dropped after a test."""
+    community_cache.clear()
+
+
 @pytest.fixture()
 def queue(app):
     """Get queue object for testing bulk operations."""
@@ -190,6 +197,17 @@ def deposit_dump(datadir):
     return dep_dumps
 
 
+@pytest.fixture()
+def legacy_records(datadir):
+    """Load test data of legacy records.
+
+    :returns: Loaded legacy records (as a list of dict).
+    :rtype: list
+    """
+    with open(join(datadir, 'legacy_records.json')) as fp:
+        return json.load(fp)
+
+
 @pytest.fixture()
 def users(app, db):
     """Create users."""
@@ -0,0 +1,76 @@
+
+# -*- coding: utf-8 -*-
+#
+# This file is part of Zenodo.
+# Copyright (C) 2017 CERN.
+#
+# Zenodo is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Zenodo is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Zenodo; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+
+"""Migration checkpoint tests."""
+
+from __future__ import absolute_import, print_function
+
+from zenodo_migrator.checkpoint import MigrationCheckpoint
+
+
+def test_checkpoint(tmpdir):
+    """Test storing and resuming the progress of a migration."""
+    path = str(tmpdir.join('checkpoint.db'))
+    with MigrationCheckpoint(path) as checkpoint:
+        assert checkpoint.last_uuid is None
+        checkpoint.mark([])
+        assert checkpoint.last_uuid is None
+        checkpoint.mark(['a', 'b', 'c'], failed=['b'])
+        checkpoint.mark(['d'], status='dispatched')
+
+    with MigrationCheckpoint(path) as checkpoint:
+        assert checkpoint.last_uuid == 'd'
+        assert checkpoint.status('a') == 'migrated'
+        assert checkpoint.status('b') == 'failed'
+        assert checkpoint.status('d') == 'dispatched'
+        assert checkpoint.status('e') is None
+        assert checkpoint.uuids('migrated') == ['a', 'c']
+        assert checkpoint.uuids('failed') == ['b']
+
+
+def test_checkpoint_buffering(tmpdir):
+    """Test that the marks are committed in batches."""
+    path = str(tmpdir.join('checkpoint.db'))
+    checkpoint = MigrationCheckpoint(path, commit_every=3,
+                                     commit_interval=3600)
+    checkpoint.mark(['a', 'b'])
+    # Pending marks are visible through the checkpoint itself.
+    assert checkpoint.last_uuid == 'b'
+    with MigrationCheckpoint(path) as other:
+        assert other.last_uuid is None
+    checkpoint.mark(['c'])
+    with MigrationCheckpoint(path) as other:
+        assert other.last_uuid == 'c'
+    checkpoint.mark(['d'])
+    checkpoint.close()
+    with MigrationCheckpoint(path) as other:
+        assert other.last_uuid == 'd'
+
+    checkpoint = MigrationCheckpoint(path, commit_interval=0)
+    checkpoint.mark(['e'])
+    with MigrationCheckpoint(path) as other:
+        assert other.last_uuid == 'e'
+    checkpoint.close()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Zenodo.
+# Copyright (C) 2016 CERN.
+#
+# Zenodo is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Zenodo is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Zenodo; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+
+"""Records dump cleaning tests."""
+
+from __future__ import absolute_import, print_function
+
+from zenodo_migrator.cleaner import MARCXMLCleaner, clean_record
+
+MARCXML = (
+    u'<record>\n'
+    u'  <controlfield tag="001">1</controlfield>\n'
+    u'  <datafield tag="245" ind1=" " ind2=" ">\n'
+    u'    <subfield code="a">Title</subfield>\n'
+    u'  </datafield>\n'
+    u'  <datafield tag="347" ind1=" " ind2=" ">\n'
+    u'    <subfield code="p">123</subfield>\n'
+    u'  </datafield>\n'
+    u'  <datafield tag="856" ind1="4" ind2=" ">\n'
+    u'    <subfield code="u">http://zenodo.org/record/1/a.pdf</subfield>\n'
+    u'  </datafield>\n'
+    u'</record>\n'
+)
+
+
+def dumped_record(access_right='open'):
+    """Create a dumped record with two revisions."""
+    return {
+        'record': [{
+            'json': {
+                'recid': 1,
+                'access_right': access_right,
+                'owner': {'id': 1},
+                'fft': [],
+            },
+            'marcxml': MARCXML,
+        } for _ in range(2)],
+        '_files': [{'key': 'a.pdf'}],
+    }
+
+
+def test_clean_record():
+    """Test cleaning of the dumped records."""
+    d = clean_record(dumped_record())
+    assert d['_files'] == [{'key': 'a.pdf'}]
+    for revision in d['record']:
+        assert revision['json'] == {'recid': 1, 'access_right': 'open'}
+        assert 'tag="245"' in revision['marcxml']
+        assert 'tag="347"' not in revision['marcxml']
+        assert 'tag="856"' not in revision['marcxml']
+
+    d = clean_record(dumped_record(access_right='closed'), drop_marcxml=True)
+    assert d['_files'] == []
+    assert all(revision['marcxml'] == '' for revision in d['record'])
+
+
+def test_marcxml_cleaner():
+    """Test reuse of the MARCXML cleaner."""
+    clean = MARCXMLCleaner(tags=['245'])
+    for marcxml in (MARCXML, u'<?xml version="1.0" encoding="UTF-8"?>\n' +
+                    MARCXML):
+        cleaned = clean(marcxml)
+        assert 'tag="245"' not in cleaned
+        assert 'tag="347"' in cleaned
+        assert clean(cleaned) == cleaned
@@ -28,7 +28,10 @@
 from __future__ import absolute_import, print_function
 
 import pytest
+from invenio_pidstore.models import PersistentIdentifier, PIDStatus, \
+    RecordIdentifier
 from invenio_records.api import Record
+from mock import patch
 
 
 @pytest.mark.skip(reason="No longer compatible with newest Invenio packages.")
@@ -41,3 +44,63 @@ def test_deposits_transform(app, db, deposit_dump):
         deposit = Record.create(inp)
         transformed = transform_deposit(deposit)
         assert transformed == expected, "Failed at testcase {0}".format(idx)
+
+
+def _legacy_deposit(depid, values=None):
+    """Create a minimal legacy deposit."""
+    return Record.create({
+        '_n': {'_deposit': {'id': depid, 'status': 'draft', 'owners': [1]}},
+        'drafts': {'_default': {'values': values}} if values else {},
+    })
+
+
+def test_migrate_deposits_failure(app, db):
+    """Test that a failing deposit does not affect the rest of the batch."""
+    from zenodo_migrator.deposit import migrate_deposits
+    # Depid 5 is already taken and the next identifiers of the sequence are
+    # the depids 6 and 7 of the batch.
+    PersistentIdentifier.create('recid', '5', status=PIDStatus.REGISTERED)
+    RecordIdentifier.insert(5)
+    deposits = [_legacy_deposit(5), _legacy_deposit(6),
+                _legacy_deposit(7, values={'title': 'Failing'})]
+    uuids = [str(d.id) for d in deposits]
+    db.session.commit()
+
+    # The minimal deposits are not valid against the deposit JSONSchema.
+    with patch.object(Record, 'validate'), \
+            patch('zenodo_migrator.deposit.legacyjsondump_v1_translator',
+                  side_effect=ValueError('Invalid draft.')):
+        failed = migrate_deposits(uuids)
+
+    assert len(failed) == 1
+    assert failed[0]['uuid'] == uuids[2]
+    assert failed[0]['error'] == 'Invalid draft.'
+    assert 'ValueError' in failed[0]['traceback']
+
+    first, second, third = [Record.get_record(uuid) for uuid in uuids]
+    assert '$schema' in first and first['recid'] == 8
+    assert '$schema' in second and second['recid'] == 6
+    assert '$schema' not in third
+    for recid in ('6', '8'):
+        assert PersistentIdentifier.get('recid', recid).status == \
+            PIDStatus.RESERVED
+    # The recid reserved for the failed deposit is released.
+    assert not PersistentIdentifier.query.filter_by(
+        pid_type='recid', pid_value='7').count()
+
+
+def test_migrate_deposits_malformed(app, db):
+    """Test that a malformed deposit does not affect the rest of the batch."""
+    from zenodo_migrator.deposit import migrate_deposits
+    deposits = [Record.create({'_n': {}, 'drafts': {}}), _legacy_deposit(3)]
+    uuids = [str(d.id) for d in deposits]
+    db.session.commit()
+
+    with patch.object(Record, 'validate'):
+        failed = migrate_deposits(uuids)
+
+    assert [f['uuid'] for f in failed] == [uuids[0]]
+    assert 'KeyError' in failed[0]['traceback']
+    assert '$schema' not in Record.get_record(uuids[0])
+    assert Record.get_record(uuids[1])['recid'] == 3
+    assert PersistentIdentifier.get('recid', '3').status == PIDStatus.RESERVED
@@ -27,9 +27,19 @@
 
 from __future__ import absolute_import, print_function
 
+import json
+import time
+from os.path import join
+from threading import Thread
+
+import pytest
+from github3 import GitHubEnterprise
+from invenio_github.models import Release, Repository
 from mock import patch
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 
-from zenodo_migrator.github import migrate_github_remote_account
+from zenodo_migrator.github import GitHubIDStore, _gh_api, \
+    migrate_github_remote_account, resolve_gh_repositories, sync_gh_accounts
 
 gh_data_fixtures = {
     'cern/zenodo': {
@@ -66,3 +76,164 @@ def test_github_migration(gh_api_mock, app, db, github_remote_accounts):
     gh_api_mock().api.repository = mock_gh_api_repository
     for ra in github_remote_accounts:
         migrate_github_remote_account({}, ra.id)
+    repo = Repository.query.one()
+    assert (repo.github_id, repo.name, repo.hook) == (1, 'cern/zenodo', 100)
+    assert repo.user_id == github_remote_accounts[0].user_id
+    assert sorted(r.tag for r in repo.releases) == ['v1.0', 'v1.0b1']
+
+    # Migrating again does not duplicate the releases.
+    migrate_github_remote_account(
+        {'cern/zenodo': (1, 'cern/zenodo')}, github_remote_accounts[0].id)
+    assert Release.query.count() == 2
+
+
+@pytest.yield_fixture()
+def gh_stub_server(datadir):
+    """Run a local stub of the GitHub repositories API.
+
+    The first request of every repository is rejected as exceeding the rate
+    limit, unknown repositories are not found.
+    """
+    with open(join(datadir, 'github_repository.json')) as fp:
+        repo_tmpl = json.load(fp)
+    requests = []
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            requests.append(self.path)
+            full_name = self.path.split('/repos/', 1)[1]
+            if full_name not in gh_data_fixtures:
+                status, headers = 404, {}
+                data = {'message': 'Not Found'}
+            elif requests.count(self.path) == 1:
+                status = 403
+                headers = {'X-RateLimit-Remaining': '0',
+                           'X-RateLimit-Reset': str(int(time.time()))}
+                data = {'message': 'API rate limit exceeded'}
+            else:
+                status, headers = 200, {}
+                data = dict(repo_tmpl, full_name=full_name,
+                            name=full_name.split('/')[1],
+                            **gh_data_fixtures[full_name])
+            body = json.dumps(data).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:{0}'.format(server.server_port), requests
+    server.shutdown()
+    server.server_close()
+
+
+def test_resolve_gh_repositories(app, gh_stub_server):
+    """Test concurrent resolution of the GitHub repositories."""
+    url, requests = gh_stub_server
+    accounts = [
+        (1, 1, ['cern/zenodo', 'johndoe/foobar']),
+        (2, 2, ['janefoo/foobar', 'janefoo/missing']),
+    ]
+    resolved = dict(resolve_gh_repositories(
+        accounts, jobs=2, api_factory=lambda user_id: GitHubEnterprise(url),
+        max_delay=0))
+    assert resolved == {
+        1: {'cern/zenodo': (1, 'cern/zenodo'),
+            'johndoe/foobar': (2, 'johndoe/foobar')},
+        2: {'janefoo/foobar': (3, 'janefoo/foobar')},
+    }
+    # Rate limited requests are retried, missing repositories are not.
+    assert requests.count('/api/v3/repos/cern/zenodo') == 2
+    assert requests.count('/api/v3/repos/janefoo/missing') == 1
+
+
+def test_resolve_gh_repositories_without_token(app, db, gh_stub_server):
+    """Test that an account without GitHub token is skipped."""
+    url, requests = gh_stub_server
+
+    def api_factory(user_id):
+        # The user 2 has no GitHub token.
+        return _gh_api(user_id) if user_id == 2 else GitHubEnterprise(url)
+
+    resolved = dict(resolve_gh_repositories(
+        [(1, 1, ['johndoe/foobar']), (2, 2, ['janefoo/foobar'])],
+        jobs=2, api_factory=api_factory, max_delay=0))
+    assert resolved == {1: {'johndoe/foobar': (2, 'johndoe/foobar')}, 2: {}}
+    assert '/api/v3/repos/janefoo/foobar' not in requests
+
+
+def test_github_id_store(tmpdir):
+    """Test the append-only store of GitHub IDs."""
+    path = str(tmpdir.join('gh_db.jsonl'))
+    store = GitHubIDStore(path)
+    store.add(1, 'cern/zenodo', (1, 'cern/zenodo'))
+    store.add('2', 'johndoe/foobar', (2, 'johndoe/foobar'))
+    store.add(1, 'cern/zenodo', (1, 'cern/zenodo'))
+    store.close()
+    # Simulate a crash while writing an entry.
+    with open(path, 'a') as fp:
+        fp.write('["2", "janefoo/foob')
+    assert len(open(path).readlines()) == 3
+
+    store = GitHubIDStore(path)
+    assert 1 in store and 3 not in store
+    assert store[1] == {'cern/zenodo': (1, 'cern/zenodo')}
+    assert store[3] == {}
+    store.add(2, 'janefoo/foobar', (3, 'janefoo/foobar'))
+    store.close()
+    assert GitHubIDStore(path).to_dict() == {
+        '1': {'cern/zenodo': (1, 'cern/zenodo')},
+        '2': {'johndoe/foobar': (2, 'johndoe/foobar'),
+              'janefoo/foobar': (3, 'janefoo/foobar')},
+    }
+
+
+def test_github_id_store_legacy(tmpdir):
+    """Test reading and converting a JSON GitHub IDs mapping."""
+    gh_db = {'1': {'cern/zenodo': [1, 'cern/zenodo']}, '3': {}}
+    path = str(tmpdir.join('gh_db.json'))
+    with open(path, 'w') as fp:
+        json.dump(gh_db, fp, indent=2)
+    store = GitHubIDStore(path)
+    assert store[1] == {'cern/zenodo': (1, 'cern/zenodo')}
+    store.add(2, 'johndoe/foobar', (2, 'johndoe/foobar'))
+    store.close()
+    assert len(open(path).readlines()) == 2
+    assert GitHubIDStore(path).to_dict() == {
+        '1': {'cern/zenodo': (1, 'cern/zenodo')},
+        '2': {'johndoe/foobar': (2, 'johndoe/foobar')},
+    }
+
+
+@patch('zenodo_migrator.github.GitHubAPI')
+def test_sync_gh_accounts(gh_api_mock, app, db):
+    """Test concurrent synchronization of the GitHub accounts."""
+    synced = []
+
+    class MockGitHubAPI(object):
+
+        def __init__(self, user_id):
+            self.user_id = user_id
+
+        def sync(self, hooks=True):
+            if self.user_id == 2:
+                raise ValueError('Sync failed')
+            synced.append(self.user_id)
+
+    gh_api_mock.side_effect = MockGitHubAPI
+    results = list(sync_gh_accounts([1, 2, 3], jobs=2))
+    assert [user_id for user_id, _, _ in results] == [1, 2, 3]
+    assert all(duration >= 0 for _, duration, _ in results)
+    assert [str(error) for _, _, error in results if error] == \
+        ['Sync failed']
+    assert sorted(synced) == [1, 3]
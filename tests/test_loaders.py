@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Zenodo.
+# Copyright (C) 2016 CERN.
+#
+# Zenodo is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Zenodo is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Zenodo; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+
+"""Loaders tests."""
+
+from __future__ import absolute_import, print_function
+
+import threading
+
+from marshmallow import Schema, fields
+
+from zenodo_migrator.loaders import SchemaTranslator
+
+
+class OwnerSchema(Schema):
+    """Schema collecting the owners in its context."""
+
+    id = fields.Method(deserialize='load_id')
+
+    def load_id(self, value):
+        """Collect the owner in the context."""
+        self.context.setdefault('owners', []).append(value)
+        return value
+
+
+class DepositSchema(Schema):
+    """Schema with a nested schema sharing its context."""
+
+    class Meta:
+        """Load the fields in declaration order."""
+
+        ordered = True
+
+    title = fields.String()
+    owners = fields.Nested(OwnerSchema, many=True)
+    context_owners = fields.Method(deserialize='load_context_owners')
+
+    def load_context_owners(self, value):
+        """Get the owners collected in the context."""
+        return list(self.context.get('owners', []))
+
+
+def test_schema_translator():
+    """Test that successive loads do not share any state."""
+    translate = SchemaTranslator(DepositSchema, banned_prefixes=())
+    data = dict(title='Test', owners=[{'id': 1}, {'id': 2}],
+                context_owners=True)
+    first = translate(dict(data))
+    assert first == dict(title='Test', owners=[{'id': 1}, {'id': 2}],
+                         context_owners=[1, 2])
+    # Same values give the same result, without the context of the
+    # previous load.
+    assert translate(dict(data)) == first
+    assert translate.schema.context['owners'] == [1, 2]
+    assert translate(dict(owners=[{'id': 3}], context_owners=True)) == \
+        dict(owners=[{'id': 3}], context_owners=[3])
+    assert translate.schema.context == dict(
+        replace_refs=False, banned_prefixes=(), owners=[3])
+    assert translate.context == dict(replace_refs=False, banned_prefixes=())
+
+
+def test_schema_translator_threads():
+    """Test that every thread uses its own schema instance."""
+    translate = SchemaTranslator(DepositSchema)
+    schemas, results = [translate.schema], []
+
+    def load(owner):
+        schemas.append(translate.schema)
+        results.append(translate(dict(owners=[{'id': owner}],
+                                      context_owners=True)))
+
+    threads = [threading.Thread(target=load, args=(i, )) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(id(schema) for schema in schemas)) == 5
+    assert sorted(r['context_owners'] for r in results) == \
+        [[0], [1], [2], [3]]
+    assert translate.schema is schemas[0]
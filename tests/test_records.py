@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Zenodo.
+# Copyright (C) 2016 CERN.
+#
+# Zenodo is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Zenodo is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Zenodo; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+
+"""Record API tests."""
+
+from __future__ import absolute_import, print_function
+
+import pytest
+from invenio_records.api import Record
+from jsonschema.exceptions import ValidationError
+
+from zenodo_migrator.records import MigrationRecord, get_record_validator
+
+SCHEMA_URL = 'https://zenodo.org/schemas/records/record-v1.0.0.json'
+
+
+def test_record_validator_cache(app):
+    """Test caching of the JSON Schema validators."""
+    assert get_record_validator(SCHEMA_URL) is \
+        get_record_validator(SCHEMA_URL)
+
+
+@pytest.mark.parametrize('record_cls', [Record, MigrationRecord])
+def test_migration_record_validation(app, record_cls):
+    """Test that cached validation matches the Invenio validation."""
+    with pytest.raises(ValidationError):
+        record_cls({'$schema': SCHEMA_URL, 'recid': 'invalid'}).validate()
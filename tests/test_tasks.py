@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Zenodo.
+# Copyright (C) 2016 CERN.
+#
+# Zenodo is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Zenodo is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Zenodo; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+
+"""Migration tasks tests."""
+
+from __future__ import absolute_import, print_function
+
+import json
+
+from mock import patch
+
+from zenodo_migrator.tasks import migrate_records
+
+
+def test_migrate_records_failures_file(app, tmpdir):
+    """Test that the batch migration task stores its failures."""
+    path = tmpdir.join('failures.jsonl')
+    failures = [dict(uuid='1', error='Foo', traceback='Traceback')]
+    app.config['ZENODO_MIGRATOR_FAILURES_FILE'] = str(path)
+    try:
+        with patch('zenodo_migrator.tasks.migrate_records_func',
+                   return_value=failures):
+            migrate_records.delay(['1', '2'])
+            migrate_records.delay(['1', '2'])
+        with patch('zenodo_migrator.tasks.migrate_records_func',
+                   return_value=[]):
+            migrate_records.delay(['3'])
+    finally:
+        app.config['ZENODO_MIGRATOR_FAILURES_FILE'] = None
+    assert [json.loads(line) for line in path.readlines()] == failures * 2
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Zenodo.
+# Copyright (C) 2016 CERN.
+#
+# Zenodo is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Zenodo is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Zenodo; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+
+"""Record transformation tests."""
+
+from __future__ import absolute_import, print_function
+
+import uuid
+from copy import deepcopy
+
+from invenio_communities.models import Community, InclusionRequest
+from invenio_communities.signals import inclusion_request_created
+from invenio_pidstore.models import PersistentIdentifier, PIDStatus
+from invenio_records.api import Record
+from mock import patch
+
+from zenodo_migrator.records import MigrationRecord
+from zenodo_migrator.transform import RECORD_TRANSFORMATIONS, \
+    CommunityCache, RecordTransformationPipeline, TransformationProfiler, \
+    _doi_pid_data, _migrate_record, community_cache, create_dois, \
+    create_inclusion_requests, migrate_records, transform_record
+
+
+def test_transformation_pipeline(legacy_records):
+    """Test equivalence of the compiled pipeline and transform_record."""
+    pipeline = RecordTransformationPipeline(updated='2017-01-01T00:00:00Z')
+    for legacy_record in legacy_records:
+        expected = transform_record(deepcopy(legacy_record))
+        if '_oai' in expected:
+            expected['_oai']['updated'] = '2017-01-01T00:00:00Z'
+        assert pipeline(deepcopy(legacy_record)) == expected
+        # Already migrated records are not transformed again.
+        assert pipeline(deepcopy(expected)) == expected
+
+    # Transformations not applying to the minimal record are skipped.
+    names = [name for name, _ in pipeline.compile(legacy_records[1])]
+    assert names == ['_migrate_upload_type', '_migrate_authors',
+                     '_migrate_owners', '_migrate_description', '_add_schema']
+    assert len(pipeline.compile(legacy_records[0])) == \
+        len(RECORD_TRANSFORMATIONS)
+
+
+def test_transform_record_profiling(legacy_records):
+    """Test profiling of the record transformations."""
+    profiler = TransformationProfiler()
+    for record in legacy_records:
+        transform_record(record, profiler=profiler)
+    assert set(profiler.stats) == \
+        set(func.__name__ for func in RECORD_TRANSFORMATIONS)
+    assert all(calls == len(legacy_records)
+               for calls, _ in profiler.stats.values())
+
+    other = TransformationProfiler()
+    other.merge(profiler.stats)
+    other.merge(profiler.stats)
+    assert other.stats['_add_schema'][0] == 2 * len(legacy_records)
+
+    summary = profiler.summary().splitlines()
+    assert len(summary) == len(RECORD_TRANSFORMATIONS) + 1
+    assert summary[0].startswith('Transformation')
+
+
+def test_create_dois(app, db):
+    """Test bulk creation of DOIs with conflicts detection."""
+    PersistentIdentifier.create('doi', '10.1234/existing')
+    dois = [
+        _doi_pid_data('10.5281/zenodo.1', uuid.uuid4()),
+        _doi_pid_data('10.1234/external', uuid.uuid4()),
+        _doi_pid_data('10.1234/existing', uuid.uuid4()),
+        _doi_pid_data('10.5281/zenodo.1', uuid.uuid4()),
+    ]
+    conflicts = create_dois(dois)
+    assert conflicts == [dois[2], dois[3]]
+
+    internal = PersistentIdentifier.get('doi', '10.5281/zenodo.1')
+    assert internal.status == PIDStatus.REGISTERED
+    assert internal.pid_provider == 'datacite'
+    assert internal.object_uuid == dois[0]['object_uuid']
+    external = PersistentIdentifier.get('doi', '10.1234/external')
+    assert external.status == PIDStatus.RESERVED
+    assert external.pid_provider is None
+
+
+def test_create_inclusion_requests(app, db, users):
+    """Test bulk creation of inclusion requests."""
+    Community.create('zenodo', users[0]['id'])
+    record = Record.create({'title': 'Test'})
+    db.session.commit()
+    community_cache.load()
+    assert 'zenodo' in community_cache
+    assert 'missing' not in community_cache
+
+    Community.create('ecfunded', users[0]['id'])
+    assert 'ecfunded' in community_cache
+
+    sent = []
+
+    def receiver(sender, request=None, notify=True, **kwargs):
+        sent.append((request.id_community, request.id_record, notify))
+
+    with inclusion_request_created.connected_to(receiver):
+        create_inclusion_requests([
+            ('zenodo', record.id), ('zenodo', record.id),
+            ('missing', record.id)])
+        create_inclusion_requests([
+            ('zenodo', record.id), ('ecfunded', record.id)])
+    assert set(
+        (ir.id_community, ir.id_record) for ir in InclusionRequest.query
+    ) == set([('zenodo', record.id), ('ecfunded', record.id)])
+    # The signal is sent once per created request, without notification.
+    assert sorted(sent) == [
+        ('ecfunded', record.id, False), ('zenodo', record.id, False)]
+
+    # Communities deleted since the cache was loaded are skipped.
+    other = Record.create({'title': 'Other'})
+    Community.get('ecfunded').delete()
+    assert 'ecfunded' in community_cache
+    create_inclusion_requests([('ecfunded', other.id), ('zenodo', other.id)])
+    assert [ir.id_community for ir in InclusionRequest.get_by_record(
+        other.id)] == ['zenodo']
+
+
+def test_community_cache_ttl(app, db, users):
+    """Test that the community cache drops the deleted communities."""
+    cache = CommunityCache(ttl=3600)
+    community = Community.create('zenodo', users[0]['id'])
+    db.session.commit()
+    assert 'zenodo' in cache
+    community.delete()
+    db.session.commit()
+    assert 'zenodo' in cache
+    cache.ttl = 0
+    assert 'zenodo' not in cache
+
+
+def test_migrate_record_obsolete_inclusion_request(app, db,
+                                                   legacy_records):
+    """Test that no request is made to communities having the record."""
+    legacy_record = deepcopy(legacy_records[1])
+    legacy_record.update(
+        communities=['zenodo'], provisional_communities=['zenodo', 'other'])
+    record = MigrationRecord(legacy_record)
+    with patch.object(MigrationRecord, 'commit'):
+        migrated, communities = _migrate_record(record, transform_record)
+    assert migrated['communities'] == ['zenodo']
+    assert communities == ['other']
+
+
+def test_migrate_records_failure(app, db, legacy_records):
+    """Test that a failing record does not affect the rest of the batch."""
+    uuids = []
+    for legacy_record in legacy_records:
+        record = Record.create(deepcopy(legacy_record))
+        PersistentIdentifier.create(
+            'recid', str(legacy_record['recid']), object_type='rec',
+            object_uuid=record.id, status=PIDStatus.REGISTERED)
+        uuids.append(str(record.id))
+    db.session.commit()
+
+    def failing_migrate_record(record, transform, logger=None):
+        # Fail after the migrated record was flushed in the savepoint.
+        result = _migrate_record(record, transform, logger=logger)
+        if record['recid'] == 2:
+            raise ValueError('Transformation failed.')
+        return result
+
+    # Only the isolation of the failures is tested, not the JSON Schema.
+    with patch('zenodo_migrator.transform._migrate_record',
+               failing_migrate_record), \
+            patch.object(MigrationRecord, 'validate'):
+        failed = migrate_records(uuids)
+
+    assert len(failed) == 1
+    assert failed[0]['uuid'] == uuids[1]
+    assert failed[0]['error'] == 'Transformation failed.'
+    assert 'ValueError' in failed[0]['traceback']
+
+    first, second, third = [Record.get_record(uuid) for uuid in uuids]
+    assert '$schema' in first
+    assert '$schema' not in second
+    assert second == legacy_records[1]
+    assert '$schema' in third
+    # The recid of the failed record is marked as reserved.
+    statuses = [PersistentIdentifier.get('recid', str(recid)).status
+                for recid in (1, 2, 3)]
+    assert statuses == [
+        PIDStatus.REGISTERED, PIDStatus.RESERVED, PIDStatus.REGISTERED]
+
+
+def test_migrate_records_doi_conflict(app, db, legacy_records):
+    """Test that records with a conflicting DOI are reported."""
+    existing = PersistentIdentifier.create('doi', '10.1234/existing')
+    records = []
+    for recid, doi in ((1, '10.1234/existing'), (2, '10.1234/new')):
+        legacy_record = deepcopy(legacy_records[1])
+        legacy_record.update(recid=recid, doi=doi)
+        records.append(Record.create(legacy_record))
+    db.session.commit()
+
+    with patch.object(MigrationRecord, 'validate'):
+        failed = migrate_records([str(r.id) for r in records])
+
+    assert failed == [dict(
+        uuid=str(records[0].id), doi='10.1234/existing',
+        error='DOI 10.1234/existing already exists.', traceback=None)]
+    assert all('$schema' in Record.get_record(r.id) for r in records)
+    assert PersistentIdentifier.get('doi', '10.1234/existing').object_uuid \
+        == existing.object_uuid
+    assert PersistentIdentifier.get('doi', '10.1234/new').object_uuid == \
+        records[1].id
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Zenodo.
+# Copyright (C) 2016 CERN.
+#
+# Zenodo is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Zenodo is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Zenodo; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+
+"""Utilities tests."""
+
+from __future__ import absolute_import, print_function
+
+import json
+
+import pytest
+from six import StringIO
+
+from zenodo_migrator.utils import chunks, iter_json_array, parallel_imap, \
+    write_failures
+
+
+@pytest.mark.parametrize('data', [
+    [],
+    [{'recid': 1}],
+    [{'recid': 1, 'title': 'Foo ] bar, [baz'}, {'recid': 2, 'keywords': []}],
+    [12345, -1.5e-10, 'foo', None, True, [1, [2]]],
+])
+def test_iter_json_array(data):
+    """Test incremental decoding of JSON arrays."""
+    for indent in (None, 2):
+        dump = json.dumps(data, indent=indent)
+        for chunk_size in (1, 3, 65536):
+            assert list(iter_json_array(StringIO(dump), chunk_size)) == data
+
+
+@pytest.mark.parametrize('dump', ['', '{}', '[1,', '[1 2]', '[1,]'])
+def test_iter_json_array_invalid(dump):
+    """Test decoding of invalid JSON arrays."""
+    with pytest.raises(ValueError):
+        list(iter_json_array(StringIO(dump), 2))
+
+
+def test_chunks():
+    """Test splitting of iterables into chunks."""
+    assert list(chunks(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(chunks([], 2)) == []
+
+
+def test_write_failures():
+    """Test writing of failures as JSON lines."""
+    fp = StringIO()
+    write_failures(fp, [])
+    assert fp.getvalue() == ''
+    failures = [{'uuid': '1', 'error': 'Foo'}, {'uuid': '2', 'error': 'Bar'}]
+    write_failures(fp, failures)
+    write_failures(fp, failures[:1])
+    assert [json.loads(line) for line in fp.getvalue().splitlines()] == \
+        failures + failures[:1]
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_parallel_imap(jobs):
+    """Test ordered mapping in a process pool."""
+    assert list(parallel_imap(abs, range(0, -500, -1), jobs=jobs,
+                              chunksize=3)) == list(range(500))
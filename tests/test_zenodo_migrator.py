@@ -60,6 +60,19 @@ def test_cli_group(script_info):
     assert result.exit_code == 0
 
 
+def test_recordsrun_recid_checkpoint(script_info, tmpdir):
+    """Test that a single record cannot be migrated with a checkpoint."""
+    runner = CliRunner()
+    result = runner.invoke(
+        migration, ['recordsrun', '--recid', '1',
+                    '--checkpoint', str(tmpdir.join('checkpoint.db'))],
+        obj=script_info)
+    assert result.exit_code == 2
+    assert '--recid cannot be used together with --checkpoint' in \
+        result.output
+    assert not tmpdir.join('checkpoint.db').check()
+
+
 # def test_loadrecords(script_info, db, queue):
 #     """Test migration command."""
 #     runner = CliRunner()
@@ -99,3 +112,13 @@ def test_cli_group(script_info):
 #     # create_record also indexes the record.
 #     with patch('invenio_indexer.api.bulk', mock_bulk):
 #         assert RecordIndexer().process_bulk_queue()[0] == 1
+
+
+def test_recordstest_dump_jobs(script_info):
+    """Test that the records cannot be dumped when tested in processes."""
+    runner = CliRunner()
+    result = runner.invoke(
+        migration, ['recordstest', '--with-dump', '--jobs', '2'],
+        obj=script_info)
+    assert result.exit_code == 2
+    assert '--with-dump cannot be used together with --jobs' in result.output
@@ -0,0 +1,141 @@
+
+# -*- coding: utf-8 -*-
+#
+# This file is part of Zenodo.
+# Copyright (C) 2017 CERN.
+#
+# Zenodo is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Zenodo is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Zenodo; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+
+"""Checkpoint store of the progress of a migration."""
+
+from __future__ import absolute_import, print_function
+
+import sqlite3
+import time
+
+
+class MigrationCheckpoint(object):
+    """Progress of a migration stored in a local SQLite database.
+
+    The store keeps the last processed UUID (the UUIDs are processed in
+    ascending order) and the status of every processed UUID, so that a
+    restarted migration can skip what has already been done without
+    fetching the records again.
+
+    The marks are committed every ``commit_every`` UUIDs or every
+    ``commit_interval`` seconds, and when the checkpoint is flushed or
+    closed. If the process is killed, the UUIDs marked since the last commit
+    are processed again (already migrated records are skipped).
+    """
+
+    def __init__(self, path, commit_every=1000, commit_interval=5):
+        """Open (and create if needed) the checkpoint database.
+
+        :param path: Path of the SQLite database.
+        :type path: str
+        :param commit_every: Number of marked UUIDs after which the marks
+            are committed.
+        :type commit_every: int
+        :param commit_interval: Number of seconds after which the marks are
+            committed.
+        :type commit_interval: float
+        """
+        self.path = path
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self._pending = 0
+        self._committed_at = time.time()
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS progress '
+            '(key TEXT PRIMARY KEY, value TEXT)')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS records '
+            '(uuid TEXT PRIMARY KEY, status TEXT NOT NULL)')
+        self.conn.commit()
+
+    def __enter__(self):
+        """Enter the context of the checkpoint."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Close the checkpoint."""
+        self.close()
+
+    @property
+    def last_uuid(self):
+        """Last UUID processed, or None if nothing has been processed."""
+        row = self.conn.execute(
+            "SELECT value FROM progress WHERE key = 'last_uuid'").fetchone()
+        return row[0] if row else None
+
+    def mark(self, uuids, status='migrated', failed=()):
+        """Record the status of processed UUIDs.
+
+        The last of the UUIDs becomes the last processed UUID, hence the
+        UUIDs must be marked in ascending order.
+
+        :param uuids: UUIDs of the processed records.
+        :type uuids: list
+        :param status: Status of the records, e.g. 'migrated' or
+            'dispatched'.
+        :type status: str
+        :param failed: UUIDs among ``uuids`` which failed to migrate.
+        """
+        uuids = [str(uuid) for uuid in uuids]
+        if not uuids:
+            return
+        failed = set(str(uuid) for uuid in failed)
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO records (uuid, status) VALUES (?, ?)',
+            [(uuid, 'failed' if uuid in failed else status)
+             for uuid in uuids])
+        self.conn.execute(
+            "INSERT OR REPLACE INTO progress (key, value) "
+            "VALUES ('last_uuid', ?)", (uuids[-1], ))
+        self._pending += len(uuids)
+        if self._pending >= self.commit_every or \
+                time.time() - self._committed_at >= self.commit_interval:
+            self.flush()
+
+    def flush(self):
+        """Commit the pending marks."""
+        self.conn.commit()
+        self._pending = 0
+        self._committed_at = time.time()
+
+    def status(self, uuid):
+        """Get the status of a UUID, or None if it was not processed."""
+        row = self.conn.execute(
+            'SELECT status FROM records WHERE uuid = ?',
+            (str(uuid), )).fetchone()
+        return row[0] if row else None
+
+    def uuids(self, status):
+        """Get the UUIDs with given status, in ascending order."""
+        return [uuid for (uuid, ) in self.conn.execute(
+            'SELECT uuid FROM records WHERE status = ? ORDER BY uuid',
+            (status, ))]
+
+    def close(self):
+        """Commit the pending marks and close the database connection."""
+        self.flush()
+        self.conn.close()
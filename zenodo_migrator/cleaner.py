@@ -0,0 +1,109 @@
+
+# -*- coding: utf-8 -*-
+#
+# This file is part of Zenodo.
+# Copyright (C) 2017 CERN.
+#
+# Zenodo is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Zenodo is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Zenodo; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+"""Cleaning of the legacy Zenodo records dump from sensitive data."""
+
+from __future__ import absolute_import, print_function
+
+from lxml import etree
+
+#: JSON keys to remove from every record revision.
+SENSITIVE_KEYS = [
+    'restriction', 'version_history', 'fft', 'owner', 'files_to_upload',
+    'documents', 'preservation_score']
+
+#: MARCXML tags to remove from every record revision.
+SENSITIVE_TAGS = ['856', '347']
+
+
+class MARCXMLCleaner(object):
+    """Remove datafields with given tags from MARCXML.
+
+    The XPath expression and the parser are compiled once and reused for
+    every cleaned document.
+    """
+
+    def __init__(self, tags=None):
+        """Initialize the cleaner.
+
+        :param tags: MARCXML tags to remove (default: ``SENSITIVE_TAGS``).
+        :type tags: list
+        """
+        tags_query = ' or '.join(
+            ['@tag={0}'.format(t) for t in (tags or SENSITIVE_TAGS)])
+        self.xpath = etree.XPath('/record/datafield[{0}]'.format(tags_query))
+        self.parser = etree.XMLParser(encoding='utf-8')
+
+    def __call__(self, marcxml):
+        """Return the cleaned MARCXML.
+
+        :param marcxml: MARCXML document.
+        :type marcxml: str
+        """
+        # Parsing bytes also supports documents with an encoding declaration.
+        tree = etree.fromstring(
+            marcxml.encode('utf-8'), self.parser).getroottree()
+        for e in self.xpath(tree):
+            e.getparent().remove(e)
+        return etree.tostring(tree, pretty_print=True).decode('utf-8')
+
+
+#: Default MARCXML cleaner (one per process).
+clean_marcxml = MARCXMLCleaner()
+
+
+def clean_record(d, drop_marcxml=False):
+    """Clean all revisions of a dumped record.
+
+    Defined at module level, so that it can be sent to worker processes.
+
+    :param d: Dumped record (with the list of its revisions under 'record').
+    :type d: dict
+    :param drop_marcxml: Drop the MARCXML instead of cleaning it.
+    :type drop_marcxml: bool
+    """
+    d['record'] = [clean_revision(x, drop_marcxml=drop_marcxml)
+                   for x in d['record']]
+    if d['record'][-1]['json']['access_right'] != 'open':
+        d['_files'] = []
+    return d
+
+
+def clean_revision(d, drop_marcxml=False):
+    """Clean a single revision of a dumped record."""
+    # Clean JSON
+    for k in SENSITIVE_KEYS:
+        if k in d['json']:
+            del d['json'][k]
+    # Clean MARCXML
+    if drop_marcxml:
+        d['marcxml'] = ''
+    else:
+        try:
+            d['marcxml'] = clean_marcxml(d['marcxml'])
+        except etree.XMLSyntaxError:
+            print(d['json']['recid'])
+            raise
+    return d
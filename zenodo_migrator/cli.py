@@ -29,14 +29,16 @@ from __future__ import absolute_import, print_function
 import json
 import sys
 import time
-import traceback
 from datetime import datetime
+from functools import partial
+from multiprocessing.pool import ThreadPool
 
 import click
+from celery import group
 from celery.task.control import inspect
+from flask import current_app
 from flask.cli import with_appcontext
 from invenio_db import db
-from invenio_github.api import GitHubAPI
 from invenio_github.models import Repository
 from invenio_indexer.api import RecordIndexer
 from invenio_migrator.cli import dumps, loadcommon
@@ -47,23 +49,29 @@ from invenio_pidstore.models import PersistentIdentifier, PIDStatus
 from invenio_records.api import Record
 from invenio_records.models import RecordMetadata
 from invenio_sipstore.models import SIP
-from lxml import etree
-from six import StringIO
 from sqlalchemy import type_coerce
 from sqlalchemy.dialects.postgresql import JSON
 from sqlalchemy.orm import aliased
 from zenodo.modules.records.resolvers import record_resolver
 from zenodo.modules.sipstore.tasks import archive_sip
 
-from .github import migrate_github_remote_account, update_local_gh_db
+from .checkpoint import MigrationCheckpoint
+from .cleaner import clean_record
+from .deposit import migrate_deposits as migrate_deposits_func
+from .github import GitHubIDStore, github_remote_accounts_query, \
+    migrate_github_remote_account, sync_gh_accounts, update_local_gh_db
+from .records import MigrationRecord
 from .tasks import load_accessrequest, load_oaiid, load_secretlink, \
     load_sipfile, load_zenodo_user, migrate_concept_recid_sips, \
-    migrate_deposit, migrate_files, migrate_github_task, migrate_record, \
-    reconstruct_sipfiles_t, versioning_github_repository, \
-    versioning_link_records, versioning_new_deposit, \
-    versioning_published_record
+    migrate_deposit, migrate_deposits, migrate_files, migrate_github_task, \
+    migrate_record, migrate_records, reconstruct_sipfiles_t, \
+    versioning_github_repository, versioning_link_records, \
+    versioning_new_deposit, versioning_published_record
+from .transform import TransformationProfiler, check_record
 from .transform import migrate_record as migrate_record_func
-from .transform import transform_record
+from .transform import migrate_records as migrate_records_func
+from .utils import chunks, iter_json_array, iter_records, parallel_imap, \
+    push_app_context, write_failures
 
 
 #
@@ -114,118 +122,267 @@ def get_uuid_from_pid_value(pid_value, pid_type='recid'):
     return str(Record.get_record(pid.object_uuid).id)
 
 
-def get_record_uuids(pid_type='recid'):
-    """Get list of record uuids to process."""
-    uuids = [str(x[0]) for x in PersistentIdentifier.query.filter_by(
-            pid_type=pid_type, object_type='rec', status='R'
-        ).values(
-            PersistentIdentifier.object_uuid
-        )]
-    return uuids
+def record_uuids_query(pid_type='recid', after=None, ordered=False,
+                       unmigrated=True):
+    """Query the UUIDs of the registered records of given PID type.
+
+    :param after: Only query the UUIDs greater than this one (implies
+        ``ordered``).
+    :param ordered: Order the UUIDs in ascending order.
+    :type ordered: bool
+    :param unmigrated: Only query the records which are not migrated yet,
+        i.e. without a ``$schema`` (filtered in the database, so that the
+        migrated records are not loaded at all).
+    :type unmigrated: bool
+    """
+    query = db.session.query(PersistentIdentifier.object_uuid).filter(
+        PersistentIdentifier.pid_type == pid_type,
+        PersistentIdentifier.object_type == 'rec',
+        PersistentIdentifier.status == PIDStatus.REGISTERED)
+    if unmigrated:
+        query = query.join(
+            RecordMetadata,
+            RecordMetadata.id == PersistentIdentifier.object_uuid).filter(
+            type_coerce(RecordMetadata.json, JSON)[
+                ('$schema',)].astext.is_(None))
+    if after is not None:
+        query = query.filter(PersistentIdentifier.object_uuid > after)
+    if ordered or after is not None:
+        query = query.order_by(PersistentIdentifier.object_uuid)
+    return query
+
+
+def iter_record_uuids(pid_type='recid', chunk_size=1000, after=None,
+                      ordered=False, unmigrated=True):
+    """Iterate over the record uuids to process.
+
+    The UUIDs are streamed from a server-side cursor on a dedicated
+    connection, so that the first one is available right away and the
+    iteration is not affected by commits of the session.
+    """
+    query = record_uuids_query(pid_type=pid_type, after=after,
+                               ordered=ordered, unmigrated=unmigrated)
+    with db.engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(
+            query.statement)
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            for (uuid,) in rows:
+                yield str(uuid)
+
+
+def count_record_uuids(pid_type='recid', after=None, unmigrated=False):
+    """Count the record uuids to process.
+
+    By default only the PIDs are counted, without filtering out the migrated
+    records (which needs the JSON of every record), so the count is an upper
+    bound, cheap enough for a progress bar.
+    """
+    return record_uuids_query(
+        pid_type=pid_type, after=after, unmigrated=unmigrated).count()
+
+
+def check_record_dump(item, profile=False):
+    """Test the migration of a dumped record (in a worker process).
+
+    :param item: Record UUID and the record's JSON.
+    :type item: tuple
+    :param profile: Profile the transformations of the record.
+    :type profile: bool
+    :returns: Record UUID, recid, the failure (if any) and the profiling
+        statistics (if enabled).
+    :rtype: tuple
+    """
+    uuid, data = item
+    profiler = TransformationProfiler() if profile else None
+    record, failure = check_record(MigrationRecord(data), profiler=profiler)
+    return uuid, record.get('recid'), failure, \
+        profiler.stats if profiler else None
 
 
 @migration.command()
 @click.option('--recid', '-r')
 @click.option('--with-dump', '-d', is_flag=True, default=False)
 @click.option('--with-traceback', '-t', is_flag=True, default=False)
+@click.option('--jobs', '-j', type=int, default=1,
+              help='Number of processes testing the records (not with '
+                   '--with-dump).')
+@click.option('--report', type=click.File('w'), default=None,
+              help='File to which the failures are written as JSON lines.')
+@click.option('--profile', '-p', is_flag=True, default=False,
+              help='Print the time spent in each transformation.')
 @with_appcontext
-def recordstest(recid=None, with_traceback=False, with_dump=False):
+def recordstest(recid=None, with_traceback=False, with_dump=False, jobs=1,
+                report=None, profile=False):
     """Test records data migration."""
+    if with_dump and jobs > 1:
+        raise click.UsageError(
+            '--with-dump cannot be used together with --jobs.')
+    profiler = TransformationProfiler() if profile else None
     if recid:
         uuids = [get_uuid_from_pid_value(recid)]
     else:
-        uuids = get_record_uuids()
-    for uid in uuids:
-        record = Record.get_record(uid)
-        try:
+        uuids = iter_record_uuids()
+
+    def report_failure(uuid, recid, failure):
+        click.secho('Failure {0}'.format(recid or uuid), fg='red')
+        if with_traceback:
+            click.echo(failure['traceback'])
+        if report:
+            entry = dict(uuid=uuid, recid=recid, **failure)
+            del entry['traceback']
+            report.write(json.dumps(entry, sort_keys=True) + '\n')
+
+    if jobs > 1:
+        dumps = ((str(r.id), r.dumps()) for r in iter_records(uuids))
+        results = parallel_imap(
+            partial(check_record_dump, profile=profile), dumps, jobs=jobs,
+            initializer=push_app_context,
+            initargs=(current_app._get_current_object(), ))
+        for uuid, record_recid, failure, stats in results:
+            if failure:
+                report_failure(uuid, record_recid, failure)
+            if stats:
+                profiler.merge(stats)
+    else:
+        for record in iter_records(uuids, record_cls=MigrationRecord):
+            uid = str(record.id)
             if with_dump:
                 click.secho('# Before:', fg='green')
                 click.echo(
                     json.dumps(record.dumps(), indent=2, sort_keys=True))
-            record = transform_record(record)
-            record.pop('provisional_communities', None)
-            record.validate()
-            if with_dump:
+            record, failure = check_record(record, profiler=profiler)
+            if failure:
+                report_failure(uid, record.get('recid'), failure)
+            elif with_dump:
                 click.secho('# After:', fg='green')
                 click.echo(
                     json.dumps(record.dumps(), indent=2, sort_keys=True))
-            # click.secho(
-            #     'Success: {0}'.format(record.get('recid', uid)), fg='green')
-        except Exception:
-            click.secho(
-                'Failure {0}'.format(record.get('recid', uid)), fg='red')
-            if with_traceback:
-                traceback.print_exc()
+
+    if profiler:
+        click.echo(profiler.summary())
 
 
 @migration.command()
 @click.option('--no-delay', '-n', is_flag=True, default=False)
 @click.option('--recid', '-r')
+@click.option('--batch-size', '-b', type=int, default=1,
+              help='Number of records migrated in a single task.')
+@click.option('--profile', '-p', is_flag=True, default=False,
+              help='Print the time spent in each transformation '
+                   '(only with --no-delay).')
+@click.option('--failures', '-f', type=click.File('w'), default=None,
+              help='File to which the failed records are written as JSON '
+                   'lines (only with --no-delay and --batch-size, the tasks '
+                   'use ZENODO_MIGRATOR_FAILURES_FILE).')
+@click.option('--checkpoint', '-c', type=click.Path(dir_okay=False),
+              default=None,
+              help='SQLite file storing the progress of the migration, from '
+                   'which a restarted migration resumes (without --no-delay, '
+                   'only the dispatch of the records is tracked).')
 @with_appcontext
-def recordsrun(no_delay=False, recid=None):
-    """Run records data migration."""
+def recordsrun(no_delay=False, recid=None, batch_size=1, profile=False,
+               failures=None, checkpoint=None):
+    """Run records data migration.
+
+    With ``--checkpoint``, the UUIDs are processed in ascending order and
+    the progress is stored periodically (and when the command exits), so
+    that a restarted migration only streams the UUIDs after the last
+    processed one.
+
+    Without ``--no-delay``, the checkpoint only tracks the dispatch of the
+    records to the workers, not their migration: records of tasks which
+    failed or were lost are not migrated again when resuming. Run the
+    migration again without checkpoint to pick them up (migrated records
+    are skipped).
+    """
+    if recid and checkpoint:
+        raise click.UsageError(
+            '--recid cannot be used together with --checkpoint.')
+    profiler = TransformationProfiler() if profile and no_delay else None
+    checkpoint = MigrationCheckpoint(checkpoint) if checkpoint else None
     if not no_delay:
         click.echo('Sending migration background tasks..')
-    if recid:
-        uuids = [get_uuid_from_pid_value(recid)]
-    else:
-        uuids = get_record_uuids()
-    with click.progressbar(uuids) as records_bar:
-        for record_uuid in records_bar:
-            if no_delay:
-                migrate_record_func(record_uuid)
-            else:
-                migrate_record.delay(record_uuid)
+    try:
+        if recid:
+            uuids, length = [get_uuid_from_pid_value(recid)], 1
+        elif checkpoint:
+            after = checkpoint.last_uuid
+            if after:
+                click.echo('Resuming after {0}..'.format(after))
+            uuids = iter_record_uuids(after=after, ordered=True)
+            length = count_record_uuids(after=after)
+        else:
+            uuids, length = iter_record_uuids(), count_record_uuids()
+        if batch_size > 1:
+            with click.progressbar(length=length) as records_bar:
+                for batch in chunks(uuids, batch_size):
+                    if no_delay:
+                        batch_failures = migrate_records_func(
+                            batch, profiler=profiler)
+                        if failures:
+                            write_failures(failures, batch_failures)
+                        if checkpoint:
+                            checkpoint.mark(batch, failed=[
+                                f['uuid'] for f in batch_failures])
+                    else:
+                        migrate_records.delay(batch)
+                        if checkpoint:
+                            checkpoint.mark(batch, status='dispatched')
+                    records_bar.update(len(batch))
+        else:
+            with click.progressbar(uuids, length=length) as records_bar:
+                for record_uuid in records_bar:
+                    if no_delay:
+                        try:
+                            migrate_record_func(record_uuid, profiler=profiler)
+                        except Exception:
+                            if checkpoint:
+                                checkpoint.mark([record_uuid],
+                                                failed=[record_uuid])
+                            raise
+                        if checkpoint:
+                            checkpoint.mark([record_uuid])
+                    else:
+                        migrate_record.delay(record_uuid)
+                        if checkpoint:
+                            checkpoint.mark([record_uuid], status='dispatched')
+    finally:
+        if checkpoint:
+            checkpoint.close()
+    if profiler:
+        click.echo(profiler.summary())
 
 
 @migration.command()
 @click.argument('source', type=click.File('r'), default=sys.stdin)
 @click.argument('output', type=click.File('w'), default=sys.stdout)
 @click.option('--drop-marcxml', '-d', flag_value='yes', default=True)
+@click.option('--jobs', '-j', type=int, default=1,
+              help='Number of processes cleaning the records.')
 @with_appcontext
-def cleandump(source, output, drop_marcxml=False):
-    """Clean a JSON dump from Zenodo for sensitive data."""
-    click.echo("Loading dump...")
-    data = json.load(source)
-
-    keys = [
-        'restriction', 'version_history', 'fft', 'owner', 'files_to_upload',
-        'documents', 'preservation_score']
-
-    # MARCXML tags to remove
-    tags = ['856', '347']
-    tags_query = ' or '.join(['@tag={0}'.format(t) for t in tags])
-
-    def clean_all(d):
-        d['record'] = [clean(x) for x in d['record']]
-        if d['record'][-1]['json']['access_right'] != 'open':
-            d['_files'] = []
-        return d
-
-    def clean(d):
-        # Clean JSON
-        for k in keys:
-            if k in d['json']:
-                del d['json'][k]
-        # Clean MARCXML
-        if drop_marcxml:
-            d['marcxml'] = ''
-        else:
-            try:
-                parser = etree.XMLParser(encoding='utf-8')
-                tree = etree.parse(StringIO(d['marcxml']), parser)
-            except etree.XMLSyntaxError:
-                print(d['json']['recid'])
-                raise
-            for e in tree.xpath('/record/datafield[{0}]'.format(tags_query)):
-                e.getparent().remove(e)
+def cleandump(source, output, drop_marcxml=False, jobs=1):
+    """Clean a JSON dump from Zenodo for sensitive data.
 
-            d['marcxml'] = etree.tostring(
-                tree, pretty_print=True).decode('utf-8')
-        return d
+    The dump is processed one record at a time, so that the memory usage is
+    bounded by the size of the largest record, not by the size of the dump.
+    With ``--jobs``, records are cleaned in parallel and written in the input
+    order.
+    """
+    clean = partial(clean_record, drop_marcxml=drop_marcxml)
 
-    click.echo("Writing dump...")
-    json.dump([clean_all(x) for x in data], output, indent=2)
+    click.echo("Cleaning dump...")
+    # Same output as 'json.dump(data, output, indent=2)' but written record
+    # by record.
+    idx = None
+    output.write('[')
+    records = parallel_imap(clean, iter_json_array(source), jobs=jobs)
+    for idx, d in enumerate(records):
+        output.write(',\n  ' if idx else '\n  ')
+        output.write(json.dumps(d, indent=2).replace('\n', '\n  '))
+    output.write(']' if idx is None else '\n]')
 
 
 @migration.command()
@@ -260,13 +417,28 @@ def reindex(pid_type=None, uuid=None, depid=None):
 @click.option('--depid', '-d')
 @click.option('--uuid', '-u')
 @click.option('--eager', '-e', is_flag=True, default=False)
+@click.option('--batch-size', '-b', type=int, default=1,
+              help='Number of deposits migrated in a single task.')
 @with_appcontext
-def depositsrun(depid=None, uuid=None, eager=None):
+def depositsrun(depid=None, uuid=None, eager=None, batch_size=1):
     """Run records data migration."""
     assert not (depid is not None and uuid is not None), \
         "Either 'depid' or 'uuid' can be provided as parameter, but not both."
-    if not (depid or uuid):
-        with click.progressbar(get_record_uuids(pid_type='depid')) \
+    if not (depid or uuid) and batch_size > 1:
+        uuids = iter_record_uuids(pid_type='depid')
+        with click.progressbar(
+                length=count_record_uuids(pid_type='depid')) as records_bar:
+            for batch in chunks(uuids, batch_size):
+                if eager:
+                    for failure in migrate_deposits_func(batch):
+                        click.echo(" Failed at {uuid}: {error}".format(
+                            **failure))
+                else:
+                    migrate_deposits.delay(batch)
+                records_bar.update(len(batch))
+    elif not (depid or uuid):
+        with click.progressbar(iter_record_uuids(pid_type='depid'),
+                               length=count_record_uuids(pid_type='depid')) \
                 as records_bar:
             for record_uuid in records_bar:
                 if eager:
@@ -296,64 +468,141 @@ def github_update_client_id(old_client_id, new_client_id):
     db.session.commit()
 
 
+def celery_broker_available():
+    """Check if the Celery broker can be connected to."""
+    try:
+        with migrate_github_task.app.connection() as conn:
+            conn.ensure_connection(max_retries=1)
+        return True
+    except Exception:
+        return False
+
+
+def migrate_github_account(item):
+    """Migrate a GitHub remote account locally (e.g. in a worker thread).
+
+    :param item: GitHub IDs of the remote account's repositories and the
+        remote account ID.
+    :type item: tuple
+    :returns: Remote account ID and the exception if the migration failed.
+    :rtype: tuple
+    """
+    gh_db_ra, remote_account_id = item
+    try:
+        migrate_github_task.s(gh_db_ra, remote_account_id).apply(throw=True)
+        return remote_account_id, None
+    except Exception as e:
+        db.session.rollback()
+        return remote_account_id, e
+
+
 @migration.command()
-@click.option('--gh-db', '-g', type=click.File('r'), default=None)
+@click.option('--gh-db', '-g', type=click.Path(exists=True, dir_okay=False),
+              default=None)
 @click.option('--remoteaccountid', '-i')
+@click.option('--async', '-a', 'async_', is_flag=True, default=False,
+              help='Dispatch the remote accounts to the Celery workers as a '
+                   'group and collect the failures (migrate them in local '
+                   'threads if no broker is available).')
+@click.option('--jobs', '-j', type=int, default=1,
+              help='Number of threads migrating the remote accounts locally.')
 @with_appcontext
-def githubrun(gh_db, remoteaccountid):
+def githubrun(gh_db, remoteaccountid, async_=False, jobs=1):
     """Run GitHub remote accounts data migration.
 
+    The failed remote accounts are reported at the end.
+
     Example:
-       zenodo migration githubrun -i 1000 -g gh_db.json
+       zenodo migration githubrun -i 1000 -g gh_db.jsonl
     """
-    gh_db = json.load(gh_db) if gh_db is not None else {}
+    gh_db = GitHubIDStore(gh_db)
     if remoteaccountid:  # If specified, run for only one remote account
         migrate_github_remote_account(gh_db[str(remoteaccountid)],
                                       remoteaccountid)
+        return
+    gh_remote_account_ids = [
+        ra_id for (ra_id, ) in github_remote_accounts_query(
+            unmigrated=True).with_entities(RemoteAccount.id)]
+    items = [(gh_db[str(ra_id)], ra_id) for ra_id in gh_remote_account_ids]
+    failures = []
+    if async_ and celery_broker_available():
+        click.echo("Sending {0} tasks ...".format(len(items)))
+        result = group(
+            migrate_github_task.s(*item) for item in items).apply_async()
+        with click.progressbar(
+                zip(gh_remote_account_ids, result.results),
+                length=len(items)) as gh_ra_bar:
+            for ra_id, task_result in gh_ra_bar:
+                task_result.get(propagate=False)
+                if task_result.failed():
+                    failures.append((ra_id, task_result.result))
     else:
-        gh_remote_account_ids = [ra.id for ra in RemoteAccount.query.all()
-                                 if 'repos' in ra.extra_data]
-        click.echo("Sending {0} tasks ...".format(len(gh_remote_account_ids)))
-        with click.progressbar(gh_remote_account_ids) as gh_ra_bar:
-            for gh_remote_account_id in gh_ra_bar:
-                try:
-                    migrate_github_task.s(
-                        gh_db[str(gh_remote_account_id)],
-                        gh_remote_account_id).apply(throw=True)
-                except Exception as e:
-                    click.echo("Failed to migrate RA {ra_id} {e}".format(
-                        ra_id=gh_remote_account_id, e=e))
+        if async_:
+            click.echo("No broker available, migrating locally ...")
+        click.echo("Migrating {0} remote accounts ...".format(len(items)))
+        results = parallel_imap(
+            migrate_github_account, items, jobs=jobs, chunksize=1,
+            initializer=push_app_context,
+            initargs=(current_app._get_current_object(), ),
+            pool_cls=ThreadPool)
+        with click.progressbar(results, length=len(items)) as gh_ra_bar:
+            failures = [(ra_id, e) for ra_id, e in gh_ra_bar if e]
+    for ra_id, e in failures:
+        click.echo("Failed to migrate RA {ra_id} {e}".format(
+            ra_id=ra_id, e=e))
+    click.echo("{0} of {1} remote accounts failed.".format(
+        len(failures), len(items)))
 
 
 @migration.command()
-@click.argument('destination', type=click.File('w'))
-@click.option('--src', '-s', type=click.File('r'), default=None)
+@click.argument('destination', type=click.Path(dir_okay=False))
+@click.option('--src', '-s', type=click.File('r'), default=None,
+              help='JSON mapping to import (former format of the database).')
 @click.option('--remote-account-id', '-i')
+@click.option('--jobs', '-j', type=int, default=1,
+              help='Number of threads fetching the repositories.')
 @with_appcontext
-def github_update_local_db(destination, src, remote_account_id):
-    """Update the local GitHub name-to-ID mapping database."""
-    gh_db = json.load(src) if src is not None else {}
-    new_gh_db = update_local_gh_db(gh_db, remote_account_id)
-    json.dump(new_gh_db, destination, indent=2, sort_keys=True)
+def github_update_local_db(destination, src, remote_account_id, jobs=1):
+    """Update the local GitHub name-to-ID mapping database.
+
+    The database is an append-only JSON lines file, to which every fetched
+    ID is written right away, so that an interrupted update resumes where
+    it stopped.
+    """
+    gh_db = GitHubIDStore(destination)
+    try:
+        if src is not None:
+            gh_db.update(json.load(src))
+        update_local_gh_db(gh_db, remote_account_id, jobs=jobs)
+    finally:
+        gh_db.close()
 
 
 @migration.command()
+@click.option('--jobs', '-j', type=int, default=1,
+              help='Number of remote accounts synchronized concurrently.')
 @with_appcontext
-def github_sync_old_remoteaccounts():
-    """Synchronize the GitHub's remote account extra_data."""
-    def not_fetched(ra):
-        repos = ra.extra_data['repos']
-        return any(('/' in repo_name) for repo_name, _ in repos.items())
-    ras = RemoteAccount.query.all()
-    ras = [ra for ra in ras if 'repos' in ra.extra_data and not_fetched(ra)]
-    with click.progressbar(ras) as gh_ra_bar:
-        for ra in gh_ra_bar:
-            try:
-                GitHubAPI(ra.user_id).sync(hooks=False)
-                db.session.commit()
-            except Exception as e:
-                click.echo("Failed for user {0}. Error: {1}".format(ra.user_id,
-                                                                    e))
+def github_sync_old_remoteaccounts(jobs=1):
+    """Synchronize the GitHub's remote account extra_data.
+
+    Prints the failed and the slowest accounts, and a summary at the end.
+    """
+    user_ids = [user_id for (user_id, ) in github_remote_accounts_query(
+        unmigrated=True).with_entities(RemoteAccount.user_id)]
+    durations, failures = [], []
+    start = time.time()
+    with click.progressbar(sync_gh_accounts(user_ids, jobs=jobs),
+                           length=len(user_ids)) as gh_ra_bar:
+        for user_id, duration, error in gh_ra_bar:
+            durations.append((duration, user_id))
+            if error is not None:
+                failures.append((user_id, error))
+    for user_id, e in failures:
+        click.echo("Failed for user {0}. Error: {1}".format(user_id, e))
+    for duration, user_id in sorted(durations, reverse=True)[:10]:
+        click.echo("User {0}: {1:.1f}s".format(user_id, duration))
+    click.echo("Synchronized {0} accounts in {1:.1f}s ({2} failed).".format(
+        len(user_ids), time.time() - start, len(failures)))
 
 
 @migration.command()
@@ -26,28 +26,111 @@
 
 from __future__ import absolute_import, print_function
 
-from copy import deepcopy
-from functools import reduce
+import traceback
+from functools import partial, reduce
 
 from flask import current_app
+from invenio_db import db
 from invenio_pidstore.errors import PIDDoesNotExistError
 from invenio_pidstore.models import PersistentIdentifier, PIDStatus, \
     RecordIdentifier
+from sqlalchemy import func
 from werkzeug.local import LocalProxy
 
 from .loaders import legacyjsondump_v1_translator
+from .utils import iter_records
 
 current_jsonschemas = LocalProxy(
     lambda: current_app.extensions['invenio-jsonschemas']
 )
 
 
-def _migrate_recid(d):
-    """Migrate the recid information."""
+def _next_recids(count):
+    """Allocate new record identifiers.
+
+    On PostgreSQL, all identifiers are taken from the sequence of
+    ``RecordIdentifier`` with a single query.
+    """
+    if not count:
+        return []
+    if db.session.bind.dialect.name != 'postgresql':
+        return [RecordIdentifier.next() for _ in range(count)]
+    recids = [recid for (recid, ) in db.session.query(
+        func.nextval('pidstore_recid_recid_seq')).select_from(
+            func.generate_series(1, count))]
+    db.session.bulk_insert_mappings(
+        RecordIdentifier, [dict(recid=recid) for recid in recids])
+    return recids
+
+
+def _existing_recids(values):
+    """Get the values which are already registered as recids."""
+    if not values:
+        return set()
+    return set(value for (value, ) in db.session.query(
+        PersistentIdentifier.pid_value).filter(
+            PersistentIdentifier.pid_type == 'recid',
+            PersistentIdentifier.pid_value.in_(values)))
+
+
+def reserve_recids(deposits):
+    """Reserve the recids of a batch of deposits.
+
+    Like :func:`_migrate_recid`, a recid identical to the depid is reserved
+    for each deposit without a PID, or a new one if it is already taken, but
+    with one query for the taken recids, one for the new identifiers and a
+    bulk insert of the reserved PIDs. New identifiers colliding with a depid
+    of the batch or an existing recid are skipped.
+
+    :param deposits: Legacy deposits.
+    :type deposits: list
+    :returns: Mapping of the depids to the reserved recids.
+    :rtype: dict
+    """
+    depids = []
+    for d in deposits:
+        try:
+            if not d['_n']['_deposit'].get('pid'):
+                depids.append(str(d['_n']['_deposit']['id']))
+        except (AttributeError, KeyError, TypeError):
+            # Malformed deposits fail when they are migrated.
+            continue
+    if not depids:
+        return {}
+    batch = set(depids)
+    taken = _existing_recids(depids)
+    needed = sum(1 for depid in depids if depid in taken)
+    new_recids = []
+    while len(new_recids) < needed:
+        # The sequence may return values reserved as-is for other deposits
+        # of the batch or already registered, skip them and allocate more.
+        candidates = [str(recid) for recid in
+                      _next_recids(needed - len(new_recids))]
+        existing = _existing_recids(candidates)
+        new_recids.extend(recid for recid in candidates
+                          if recid not in batch and recid not in existing)
+    new_recids = iter(new_recids)
+    recids = dict((depid, next(new_recids) if depid in taken else depid)
+                  for depid in depids)
+    db.session.bulk_insert_mappings(PersistentIdentifier, [
+        dict(pid_type='recid', pid_value=recid, status=PIDStatus.RESERVED)
+        for recid in recids.values()])
+    return recids
+
+
+def _migrate_recid(d, recids=None):
+    """Migrate the recid information.
+
+    :param recids: Recids already reserved for the deposits (see
+        :func:`reserve_recids`).
+    :type recids: dict
+    """
     depid = d['_n']['_deposit']['id']
     pid = d['_n']['_deposit'].get('pid')
     if pid:
         d['_n']['recid'] = int(pid['value'])
+    elif recids and str(depid) in recids:
+        d['_n']['recid'] = int(recids[str(depid)])
     else:
         # Create a recid if we don't have one - try to reserve identical
         # number.
@@ -62,18 +145,24 @@ def _migrate_recid(d):
 
 
 def empty_if_none(d):
-    """Replace all None values with empty strings (nested)."""
+    """Replace all None values with empty strings (nested, in place)."""
     if isinstance(d, dict):
-        return dict((k, empty_if_none(v)) for k, v in d.items())
+        items = d.items()
     elif isinstance(d, list):
-        return list(empty_if_none(i) for i in d)
+        items = enumerate(d)
     else:
         return "" if d is None else d
+    for k, v in items:
+        if v is None:
+            d[k] = ""
+        elif isinstance(v, (dict, list)):
+            empty_if_none(v)
+    return d
 
 
 def _fix_none_values(d, *args):
     """Turn all 'None' values in the dictionary to empty strings."""
-    d['_n'] = empty_if_none(d['_n'])
+    empty_if_none(d['_n'])
     return d
 
 
@@ -94,22 +183,65 @@ def _finalize(d):
     d['_n'].setdefault('$schema', current_jsonschemas.path_to_url(
         current_app.config['DEPOSIT_DEFAULT_JSONSCHEMA']
     ))
-    data = deepcopy(d['_n'])
+    data = d['_n']
     d.clear()
     d.update(data)
     return d
 
 
-def transform_deposit(deposit):
-    """Transform legacy JSON."""
+def transform_deposit(deposit, recids=None):
+    """Transform legacy JSON.
+
+    :param recids: Recids already reserved for the deposits (see
+        :func:`reserve_recids`).
+    :type recids: dict
+    """
     if '$schema' in deposit:
         return deposit
 
     transformations = [
-        _migrate_recid,
+        partial(_migrate_recid, recids=recids),
         _migrate_draft,
         _fix_none_values,
         _finalize,
     ]
 
     return reduce(lambda deposit, fun: fun(deposit), transformations, deposit)
+
+
+def migrate_deposits(record_uuids, logger=None):
+    """Migrate a batch of deposits, each one in its own savepoint.
+
+    :param record_uuids: UUIDs of the deposits to migrate.
+    :type record_uuids: list
+    :returns: Failures (UUID of the deposit, error and traceback).
+    :rtype: list
+    """
+    failed = []
+    deposits = [d for d in iter_records(record_uuids) if '$schema' not in d]
+    recids = reserve_recids(deposits)
+    orphans = []
+    for deposit in deposits:
+        depid = None
+        try:
+            depid = str(deposit['_n']['_deposit']['id'])
+            with db.session.begin_nested():
+                transform_deposit(deposit, recids=recids).commit()
+        except Exception as e:
+            if logger:
+                logger.exception(
+                    "Failed to migrate deposit {0}.".format(deposit.id))
+            failed.append(dict(uuid=str(deposit.id), error=str(e),
+                               traceback=traceback.format_exc()))
+            if depid in recids:
+                orphans.append(recids[depid])
+    if orphans:
+        # Release the recids reserved for the failed deposits.
+        PersistentIdentifier.query.filter(
+            PersistentIdentifier.pid_type == 'recid',
+            PersistentIdentifier.pid_value.in_(orphans),
+            PersistentIdentifier.status == PIDStatus.RESERVED,
+            PersistentIdentifier.object_uuid.is_(None),
+        ).delete(synchronize_session=False)
+    db.session.commit()
+    return failed
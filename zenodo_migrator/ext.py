@@ -44,4 +44,6 @@ class ZenodoMigrator(object):
         app.config['MIGRATOR_RECORDS_PID_FETCHERS'] = [
             'zenodo_migrator.fetchers.legacy_oaiid'
         ]
+        # File to which the batch migration tasks append their failures.
+        app.config.setdefault('ZENODO_MIGRATOR_FAILURES_FILE', None)
         app.extensions['zenodo-migrator'] = self
@@ -26,17 +26,162 @@
 
 from __future__ import absolute_import, print_function
 
-from copy import deepcopy
+import json
+import os
+import threading
+import time
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from timeit import default_timer
 
-from github3.exceptions import AuthenticationFailed
+from flask import current_app
+from github3.exceptions import AuthenticationFailed, ForbiddenError, \
+    ServerError
 from invenio_db import db
 from invenio_github.api import GitHubAPI
-from invenio_github.errors import RepositoryAccessError
 from invenio_github.models import Release, ReleaseStatus, Repository
 from invenio_oauthclient.models import RemoteAccount
 from invenio_pidstore.errors import PIDDoesNotExistError
 from invenio_pidstore.models import PersistentIdentifier
-from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy import column, exists, func, literal_column, or_, select, \
+    type_coerce
+from sqlalchemy.dialects.postgresql import JSON
+
+from .utils import parallel_imap, push_app_context
+
+
+class GitHubIDStore(object):
+    """Append-only store of the GitHub IDs of the remote accounts' repos.
+
+    Every resolved repository is appended to a JSON lines file as
+    ``[remote_account_id, repository_name, github_id, github_full_name]``
+    and flushed right away, so that a crash does not lose the IDs fetched so
+    far. Entries are looked up in memory by remote account ID, like in the
+    ``gh_db`` mapping (see :func:`update_local_gh_db`).
+
+    A file containing the JSON ``gh_db`` mapping is read as well, and it is
+    converted to JSON lines when the first entry is added.
+    """
+
+    def __init__(self, path=None):
+        """Load the store.
+
+        :param path: Path of the store file (created if it does not exist).
+            Without a path, the store is kept in memory only.
+        :type path: str
+        """
+        self.path = path
+        self._data = {}
+        self._fp = None
+        self._lock = threading.Lock()
+        self._legacy = False
+        self._newline = False
+        if path and os.path.exists(path):
+            with open(path) as fp:
+                content = fp.read()
+            if content.lstrip().startswith('{'):
+                self._legacy = True
+                self.update(json.loads(content), persist=False)
+            else:
+                self._load_lines(content)
+
+    def _load_lines(self, content):
+        """Load the JSON lines of the store."""
+        for line in content.splitlines():
+            try:
+                ra_id, name, gh_id, gh_full_name = json.loads(line)
+            except ValueError:
+                continue  # Line truncated by a crash.
+            self._data.setdefault(str(ra_id), {})[name] = \
+                (gh_id, gh_full_name)
+        self._newline = bool(content) and not content.endswith('\n')
+
+    def _open(self):
+        """Open the store file for appending."""
+        if self._legacy:
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as fp:
+                for ra_id, repos in sorted(self._data.items()):
+                    for name, (gh_id, gh_full_name) in sorted(repos.items()):
+                        fp.write(json.dumps(
+                            [ra_id, name, gh_id, gh_full_name]) + '\n')
+            os.rename(tmp_path, self.path)
+            self._legacy = False
+        self._fp = open(self.path, 'a')
+        if self._newline:
+            self._fp.write('\n')
+
+    def __contains__(self, remote_account_id):
+        """Check if any repository of the remote account is stored."""
+        return str(remote_account_id) in self._data
+
+    def __getitem__(self, remote_account_id):
+        """Get the repositories of a remote account.
+
+        :returns: Mapping of the repository names to GitHub IDs and names
+            (empty if the remote account is not stored).
+        :rtype: dict
+        """
+        return dict(self._data.get(str(remote_account_id), {}))
+
+    def add(self, remote_account_id, repo_name, gh_info, persist=True):
+        """Add (and persist) the GitHub ID of a repository.
+
+        This method is thread-safe.
+
+        :param gh_info: GitHub ID and full name of the repository.
+        :type gh_info: tuple
+        """
+        gh_id, gh_full_name = gh_info
+        with self._lock:
+            repos = self._data.setdefault(str(remote_account_id), {})
+            if repos.get(repo_name) == (gh_id, gh_full_name):
+                return
+            if persist and self.path and self._fp is None:
+                self._open()
+            repos[repo_name] = (gh_id, gh_full_name)
+            if persist and self.path:
+                self._fp.write(json.dumps([
+                    str(remote_account_id), repo_name, gh_id,
+                    gh_full_name]) + '\n')
+                self._fp.flush()
+
+    def update(self, gh_db, persist=True):
+        """Add the entries of a ``gh_db`` mapping."""
+        for ra_id, repos in gh_db.items():
+            for name, gh_info in repos.items():
+                self.add(ra_id, name, gh_info, persist=persist)
+
+    def to_dict(self):
+        """Get the ``gh_db`` mapping of the store."""
+        return dict((ra_id, dict(repos))
+                    for ra_id, repos in self._data.items())
+
+    def close(self):
+        """Close the store file."""
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+
+def github_remote_accounts_query(unmigrated=False):
+    """Query the remote accounts with GitHub repositories.
+
+    The accounts are filtered in the database on their JSON ``extra_data``
+    (PostgreSQL only), so that remote accounts of other kinds are not loaded.
+
+    :param unmigrated: Only query the accounts with at least one repository
+        which is not migrated yet (i.e. whose name contains a ``/``).
+    :type unmigrated: bool
+    """
+    repos = type_coerce(RemoteAccount.extra_data, JSON)['repos']
+    query = RemoteAccount.query.filter(func.json_typeof(repos) == 'object')
+    if unmigrated:
+        repo_names = func.json_object_keys(repos).alias('repo_names')
+        query = query.filter(exists(
+            select([literal_column('1')]).select_from(repo_names).where(
+                column('repo_names').like('%/%'))))
+    return query
 
 
 def fetch_gh_info(full_repo_name, gh_api):
@@ -55,9 +200,117 @@ def fetch_gh_info(full_repo_name, gh_api):
         raise
 
 
+def _retry_delay(error, attempt, backoff=1.0, max_delay=900):
+    """Get the delay before retrying a failed GitHub API call.
+
+    If the rate limit of the token is exhausted, wait until the reset time
+    announced by GitHub, otherwise back off exponentially.
+    """
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    if headers.get('X-RateLimit-Remaining') == '0' and \
+            headers.get('X-RateLimit-Reset'):
+        delay = int(headers['X-RateLimit-Reset']) - time.time() + 1
+    else:
+        delay = backoff * 2 ** attempt
+    return min(max(delay, 0), max_delay)
+
+
+def fetch_gh_info_retry(full_repo_name, gh_api, retries=3, backoff=1.0,
+                        max_delay=900):
+    """Fetch the GitHub repository, retrying on rate limits and errors.
+
+    :param retries: Number of retries after a forbidden (e.g. rate limit
+        exceeded) or server error.
+    :type retries: int
+    :param backoff: Delay (in seconds) before the first retry, doubled for
+        each following retry.
+    :type backoff: float
+    :param max_delay: Maximal delay (in seconds) before a retry.
+    :type max_delay: float
+    """
+    for attempt in range(retries + 1):
+        try:
+            return fetch_gh_info(full_repo_name, gh_api)
+        except (ForbiddenError, ServerError) as e:
+            if attempt == retries:
+                raise
+            time.sleep(_retry_delay(e, attempt, backoff=backoff,
+                                    max_delay=max_delay))
+
+
+def _gh_api(user_id):
+    """Get the GitHub API client authenticated with the user's token."""
+    return GitHubAPI(user_id).api
+
+
+def _resolve_gh_account(account, api_factory=_gh_api, logger=None,
+                        store=None, **retry_kwargs):
+    """Resolve the repositories of a single remote account."""
+    remote_account_id, user_id, repo_names = account
+    resolved = {}
+    try:
+        gh_api = api_factory(user_id)
+    except Exception as e:
+        # E.g. the user has no (valid) GitHub token.
+        if logger is not None:
+            logger.exception("GH fail: no API for {id}: {e}".format(
+                id=remote_account_id, e=e))
+        return remote_account_id, resolved
+    for full_repo_name in repo_names:
+        try:
+            resolved[full_repo_name] = fetch_gh_info_retry(
+                full_repo_name, gh_api, **retry_kwargs)
+            if store is not None:
+                store.add(remote_account_id, full_repo_name,
+                          resolved[full_repo_name])
+        except Exception as e:
+            if logger is not None:
+                logger.exception("GH fail: {name} ({id}): {e}".format(
+                    name=full_repo_name, id=remote_account_id, e=e))
+    return remote_account_id, resolved
+
+
+def resolve_gh_repositories(accounts, jobs=1, api_factory=_gh_api,
+                            logger=None, store=None, **retry_kwargs):
+    """Resolve the GitHub repository names of remote accounts to IDs.
+
+    The remote accounts are resolved concurrently in up to ``jobs`` threads
+    (each with its own application context). The repositories of a single
+    account are resolved one after the other, so that each token is used by
+    a single thread and its rate limit can be waited for (see
+    :func:`fetch_gh_info_retry`).
+
+    :param accounts: Remote account ID, user ID and repository names, for
+        every remote account.
+    :type accounts: list
+    :param jobs: Number of threads calling the GitHub API.
+    :type jobs: int
+    :param api_factory: Function returning the GitHub API client of a user
+        ID.
+    :param store: Store to which every resolved repository is added as soon
+        as it is resolved.
+    :type store: `GitHubIDStore`
+    :returns: Iterator over remote account IDs and their resolved
+        repositories (``{repository_name: (id, name)}``).
+    """
+    resolve = partial(_resolve_gh_account, api_factory=api_factory,
+                      logger=logger, store=store, **retry_kwargs)
+    return parallel_imap(
+        resolve, accounts, jobs=jobs, chunksize=1,
+        initializer=push_app_context,
+        initargs=(current_app._get_current_object(), ),
+        pool_cls=ThreadPool)
+
+
 def migrate_github_remote_account(gh_db_ra, remote_account_id, logger=None):
-    """Migrate the GitHub remote accounts."""
+    """Migrate the GitHub remote accounts.
+
+    The repositories, recid PIDs and releases needed by the remote account
+    are fetched with a few queries (instead of a few per deposition) and the
+    missing releases are inserted in bulk.
+    """
     ra = RemoteAccount.query.filter_by(id=remote_account_id).first()
+    hooked = []
     for full_repo_name, repo_vals in ra.extra_data['repos'].items():
         if '/' not in full_repo_name:
             if logger is not None:
@@ -65,76 +318,98 @@ def migrate_github_remote_account(gh_db_ra, remote_account_id, logger=None):
                     name=full_repo_name, id=ra.id))
             continue
         if repo_vals['hook']:
-            owner, repo_name = full_repo_name.split('/')
             # If repository name is cached, get from database, otherwise fetch
             if full_repo_name in gh_db_ra:
                 gh_id, gh_full_name = gh_db_ra[full_repo_name]
             else:
                 gh_api = GitHubAPI(ra.user.id)
                 gh_id, gh_full_name = fetch_gh_info(full_repo_name, gh_api.api)
+            hooked.append((full_repo_name, repo_vals, gh_id, gh_full_name))
 
-            try:
-                repo = Repository.get(user_id=ra.user_id, github_id=gh_id,
-                                      name=gh_full_name)
-            except NoResultFound:
-                repo = Repository.create(user_id=ra.user_id, github_id=gh_id,
-                                         name=gh_full_name)
-            except RepositoryAccessError as e:
-                if logger is not None:
+    repos = []
+    if hooked:
+        existing = Repository.query.filter(or_(
+            Repository.github_id.in_([h[2] for h in hooked]),
+            Repository.name.in_([h[3] for h in hooked]))).all()
+        by_github_id = dict((r.github_id, r) for r in existing)
+        by_name = dict((r.name, r) for r in existing)
+    for full_repo_name, repo_vals, gh_id, gh_full_name in hooked:
+        repo = by_github_id.get(gh_id) or by_name.get(gh_full_name)
+        if repo is None:
+            repo = Repository(user_id=ra.user_id, github_id=gh_id,
+                              name=gh_full_name)
+            db.session.add(repo)
+            by_github_id[gh_id] = by_name[gh_full_name] = repo
+        elif repo.user_id and repo.user_id != ra.user_id:
+            if logger is not None:
+                logger.warning(
+                    "User (uid: {user_id}) repository "
+                    "'{repo_name}' from remote account ID:{ra_id} has "
+                    "already been claimed by another user ({user2_id})."
+                    "Repository ID: {repo_id}.".format(
+                        user_id=ra.user.id, repo_name=full_repo_name,
+                        ra_id=ra.id, user2_id=repo.user_id,
+                        repo_id=repo.id))
+            continue
+            # TODO: Hook for this user will not be added.
+        repo.hook = repo_vals['hook']
+        repos.append((repo, repo_vals['depositions'] or []))
+    db.session.flush()
 
-                    repo = Repository.query.filter_by(github_id=gh_id).one()
-                    logger.warning(
-                        "User (uid: {user_id}) repository "
-                        "'{repo_name}' from remote account ID:{ra_id} has "
-                        "already been claimed by another user ({user2_id})."
-                        "Repository ID: {repo_id}.".format(
-                            user_id=ra.user.id, repo_name=full_repo_name,
-                            ra_id=ra.id, user2_id=repo.user_id,
-                            repo_id=repo.id))
-                continue
-                # TODO: Hook for this user will not be added.
-            repo.hook = repo_vals['hook']
-            if repo_vals['depositions']:
-                for dep in repo_vals['depositions']:
-                    try:
-                        pid = PersistentIdentifier.get(
-                            pid_type='recid', pid_value=str(dep['record_id']))
-                        release = Release.query.filter_by(
-                            tag=dep['github_ref'], repository_id=repo.id,
-                            record_id=pid.get_assigned_object()).first()
-                        if not release:
-                            release = Release(
-                                tag=dep['github_ref'], errors=dep['errors'],
-                                record_id=pid.get_assigned_object(),
-                                repository_id=repo.id,
-                                status=ReleaseStatus.PUBLISHED)
-                            # TODO: DO SOMETHING WITH dep['doi']
-                            # TODO: Update the date dep['submitted']
-                            db.session.add(release)
-                    except PIDDoesNotExistError as e:
-                        if logger is not None:
-                            logger.exception(
-                                'Could not create release {tag} for repository'
-                                ' {repo_id}, because corresponding PID: {pid} '
-                                'does not exist')
-                        raise e
+    recids = set(str(dep['record_id']) for _, deps in repos for dep in deps)
+    record_uuids, releases = {}, set()
+    if recids:
+        record_uuids = dict(db.session.query(
+            PersistentIdentifier.pid_value,
+            PersistentIdentifier.object_uuid).filter(
+                PersistentIdentifier.pid_type == 'recid',
+                PersistentIdentifier.pid_value.in_(recids)))
+        releases = set(db.session.query(
+            Release.tag, Release.repository_id, Release.record_id).filter(
+                Release.repository_id.in_([repo.id for repo, _ in repos])))
+
+    new_releases = []
+    for repo, deps in repos:
+        for dep in deps:
+            recid = str(dep['record_id'])
+            if recid not in record_uuids:
+                if logger is not None:
+                    logger.error(
+                        'Could not create release {tag} for repository '
+                        '{repo_id}, because corresponding PID: {pid} does '
+                        'not exist'.format(tag=dep['github_ref'],
+                                           repo_id=repo.id, pid=recid))
+                raise PIDDoesNotExistError('recid', recid)
+            key = (dep['github_ref'], repo.id, record_uuids[recid])
+            if key not in releases:
+                releases.add(key)
+                # TODO: DO SOMETHING WITH dep['doi']
+                # TODO: Update the date dep['submitted']
+                new_releases.append(dict(
+                    tag=dep['github_ref'], errors=dep['errors'],
+                    record_id=record_uuids[recid], repository_id=repo.id,
+                    status=ReleaseStatus.PUBLISHED))
+    if new_releases:
+        db.session.bulk_insert_mappings(Release, new_releases)
     db.session.commit()
 
 
-def update_local_gh_db(gh_db, remote_account_id, logger=None):
+def update_local_gh_db(gh_db, remote_account_id, logger=None, jobs=1):
     """Fetch the missing GitHub repositories (from RemoteAccount information).
 
-    :param gh_db: mapping from remote accounts information to github IDs.
-    :type gh_db: dict
-    :param dst_path: Path to destination file.
-    :type dst_path: str
+    :param gh_db: Store of the mapping from remote accounts information to
+        github IDs, updated in place.
+    :type gh_db: `GitHubIDStore`
     :param remote_account_id: Specify a single remote account ID to update.
     :type remote_account_id: int
+    :param jobs: Number of threads fetching the repositories from GitHub.
+    :type jobs: int
 
     Updates the local GitHub repository name mapping (``gh_db``) with the
-    missing entries from RemoteAccount query.
+    missing entries from RemoteAccount query. Every fetched entry is
+    persisted as soon as it is fetched.
 
-    The exact structure of the ``gh_db`` dictionary is as follows:
+    The exact structure of the ``gh_db`` mapping is as follows:
     gh_db[remote_account_id:str][repository_name:str] = (id:int, name:str)
     E.g.:
         gh_db = {
@@ -149,17 +424,14 @@ def update_local_gh_db(gh_db, remote_account_id, logger=None):
           "3456": {}  # No active repositories for this remote account.
         }
     """
-    gh_db = deepcopy(gh_db)
     if remote_account_id:
         gh_ras = [RemoteAccount.query.filter_by(id=remote_account_id).one(), ]
     else:
-        gh_ras = [ra for ra in RemoteAccount.query.all()
-                  if 'repos' in ra.extra_data]
+        gh_ras = github_remote_accounts_query(unmigrated=True).yield_per(100)
+    accounts = []
     for ra in gh_ras:
-        gh_db.setdefault(str(ra.id), dict())
-        repos = ra.extra_data['repos'].items()
-        gh_api = GitHubAPI(ra.user.id)
-        for full_repo_name, repo_vals in repos:
+        repo_names = []
+        for full_repo_name, repo_vals in ra.extra_data['repos'].items():
             if '/' not in full_repo_name:
                 if logger is not None:
                     logger.warning("Repository migrated: {name} ({id})".format(
@@ -168,11 +440,43 @@ def update_local_gh_db(gh_db, remote_account_id, logger=None):
             if not repo_vals['hook']:
                 continue
             if full_repo_name not in gh_db[str(ra.id)]:
-                try:
-                    repo_info = fetch_gh_info(full_repo_name, gh_api.api)
-                    gh_db[str(ra.id)][full_repo_name] = repo_info
-                except Exception as e:
-                    if logger is not None:
-                        logger.exception("GH fail: {name} ({id}): {e}".format(
-                            name=full_repo_name, id=ra.id, e=e))
+                repo_names.append(full_repo_name)
+        if repo_names:
+            accounts.append((ra.id, ra.user_id, repo_names))
+    for _ in resolve_gh_repositories(
+            accounts, jobs=jobs, logger=logger, store=gh_db):
+        pass
     return gh_db
+
+
+def _sync_gh_account(user_id, app=None):
+    """Synchronize the GitHub repositories of a user in its own context."""
+    with app.app_context():
+        start = default_timer()
+        try:
+            GitHubAPI(user_id).sync(hooks=False)
+            db.session.commit()
+            error = None
+        except Exception as e:
+            db.session.rollback()
+            error = e
+        return user_id, default_timer() - start, error
+
+
+def sync_gh_accounts(user_ids, jobs=1):
+    """Synchronize the GitHub repositories of users.
+
+    Up to ``jobs`` users are synchronized concurrently in threads. Every
+    user is synchronized in its own application context (hence database
+    session), so that a failure does not affect the other users.
+
+    :param user_ids: IDs of the users to synchronize.
+    :type user_ids: list
+    :param jobs: Number of threads synchronizing the users.
+    :type jobs: int
+    :returns: Iterator over the user ID, the duration of the synchronization
+        (in seconds) and the exception if it failed, for every user.
+    """
+    sync = partial(_sync_gh_account, app=current_app._get_current_object())
+    return parallel_imap(sync, user_ids, jobs=jobs, chunksize=1,
+                         pool_cls=ThreadPool)
@@ -27,10 +27,53 @@
 
 from __future__ import absolute_import, print_function
 
-from zenodo.modules.deposit.loaders.base import marshmallow_loader
+import threading
+
+from zenodo.modules.deposit.errors import MarshmallowErrors
 
 from .serializers.schemas.dump import DumpLegacyRecordSchemaV1
 
+
+class SchemaTranslator(object):
+    """Marshmallow translator reusing its schema instance.
+
+    Unlike ``marshmallow_loader``, which builds the schema (and all its
+    nested schemas) on every call, the schema is built once per thread, as a
+    schema instance holds the state of the ongoing load. The data is always
+    loaded outside of a request, with the same context.
+    """
+
+    def __init__(self, schema_class, **context):
+        """Initialize the translator.
+
+        :param schema_class: Marshmallow schema class.
+        :param context: Context of the schema.
+        """
+        self.schema_class = schema_class
+        self.context = dict(replace_refs=False, **context)
+        self._local = threading.local()
+
+    @property
+    def schema(self):
+        """Schema instance of the current thread."""
+        schema = getattr(self._local, 'schema', None)
+        if schema is None:
+            schema = self._local.schema = self.schema_class(
+                context=dict(self.context))
+        return schema
+
+    def __call__(self, data):
+        """Translate the data."""
+        schema = self.schema
+        # Nested schemas share the context dict, hence reset it in place.
+        schema.context.clear()
+        schema.context.update(self.context)
+        result = schema.load(data)
+        if result.errors:
+            raise MarshmallowErrors(result.errors)
+        return result.data
+
+
 #: Legacy deposit dump translator
-legacyjsondump_v1_translator = marshmallow_loader(
+legacyjsondump_v1_translator = SchemaTranslator(
     DumpLegacyRecordSchemaV1, banned_prefixes=())
@@ -27,7 +27,43 @@
 from __future__ import absolute_import, print_function
 
 import arrow
+from flask import current_app
 from invenio_migrator.records import RecordDump
+from invenio_records.api import Record
+from jsonschema.validators import validator_for
+
+_validators = {}
+
+
+def get_record_validator(schema_url):
+    """Get a JSON Schema validator for the schema URL.
+
+    The validator (and its reference resolver, which caches the resolved
+    ``$ref`` schemas) is created once per process and schema URL.
+
+    :param schema_url: URL of the JSON Schema.
+    :type schema_url: str
+    """
+    if schema_url not in _validators:
+        records_state = current_app.extensions['invenio-records']
+        schema = {'$ref': schema_url}
+        validator_cls = validator_for(schema)
+        validator_cls.check_schema(schema)
+        _validators[schema_url] = validator_cls(
+            schema,
+            resolver=records_state.ref_resolver_cls.from_schema(schema),
+            types=current_app.config.get('RECORDS_VALIDATION_TYPES', {}))
+    return _validators[schema_url]
+
+
+class MigrationRecord(Record):
+    """Record validated with cached JSON Schema validators."""
+
+    def validate(self, **kwargs):
+        """Validate the record against its ``$schema``."""
+        if kwargs or self.get('$schema') is None:
+            return super(MigrationRecord, self).validate(**kwargs)
+        get_record_validator(self['$schema']).validate(self)
 
 
 class ZenodoRecordDump(RecordDump):
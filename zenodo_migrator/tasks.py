@@ -53,9 +53,12 @@ from zenodo.modules.records.resolvers import record_resolver
 # from zenodo.modules.sipstore.utils import generate_bag_path_from_sip
 from zenodo_accessrequests.models import AccessRequest, SecretLink
 
+from .deposit import migrate_deposits as migrate_deposits_func
 from .deposit import transform_deposit
 from .github import migrate_github_remote_account
 from .transform import migrate_record as migrate_record_func
+from .transform import migrate_records as migrate_records_func
+from .utils import write_failures
 
 logger = get_task_logger(__name__)
 
@@ -67,6 +70,24 @@ def migrate_record(record_uuid):
     migrate_record_func(record_uuid, logger=logger)
 
 
+def store_failures(failures):
+    """Append failures to the file set in ``ZENODO_MIGRATOR_FAILURES_FILE``.
+
+    :param failures: Failures returned by a batch migration.
+    :type failures: list
+    """
+    path = current_app.config.get('ZENODO_MIGRATOR_FAILURES_FILE')
+    if failures and path:
+        with open(path, 'a') as fp:
+            write_failures(fp, failures)
+
+
+@shared_task(ignore_result=True)
+def migrate_records(record_uuids):
+    """Migrate a batch of records in a single transaction."""
+    store_failures(migrate_records_func(record_uuids, logger=logger))
+
+
 @shared_task(ignore_result=True)
 def migrate_files():
     """Migrate location of all files."""
@@ -90,7 +111,13 @@ def migrate_deposit(record_uuid):
     db.session.commit()
 
 
-@shared_task(ignore_results=True)
+@shared_task(ignore_result=True)
+def migrate_deposits(record_uuids):
+    """Migrate a batch of deposits in a single transaction."""
+    store_failures(migrate_deposits_func(record_uuids, logger=logger))
+
+
+@shared_task()
 def migrate_github_task(gh_db_ra, remote_account_id):
     """Migrate GitHub remote account."""
     migrate_github_remote_account(gh_db_ra, remote_account_id, logger=logger)
@@ -27,61 +27,38 @@
 
 from __future__ import absolute_import, print_function
 
+import traceback
 from datetime import datetime
-from functools import reduce
+from functools import partial, reduce
+from timeit import default_timer
 
-from invenio_communities.errors import InclusionRequestExistsError
+from flask import current_app
 from invenio_communities.models import Community, InclusionRequest
+from invenio_communities.signals import inclusion_request_created
 from invenio_db import db
 from invenio_oaiserver.response import datetime_to_datestamp
 from invenio_pidstore.models import PersistentIdentifier, PIDStatus
-from invenio_records.api import Record
+from jsonschema.exceptions import ValidationError
 from six import string_types
 from sqlalchemy.orm.exc import NoResultFound
 
+from .records import MigrationRecord
+from .utils import iter_records
 
-def migrate_record(record_uuid, logger=None):
+
+def migrate_record(record_uuid, logger=None, profiler=None):
     """Migrate a record."""
     try:
-        # Migrate record
-        record = Record.get_record(record_uuid)
-        if '$schema' in record:
-            if logger:
-                logger.info("Record already migrated.")
-            return
-        record = transform_record(record)
-        provisional_communities = record.pop('provisional_communities', None)
-        record.commit()
+        record, communities = _migrate_record(
+            MigrationRecord.get_record(record_uuid),
+            partial(transform_record, profiler=profiler), logger=logger)
         # Create provisional communities.
-        if provisional_communities:
-            for c_id in provisional_communities:
-                try:
-                    c = Community.get(c_id)
-                    if c:
-                        InclusionRequest.create(c, record, notify=False)
-                    else:
-                        if logger:
-                            logger.warning(
-                                "Community {0} does not exists "
-                                "(record {1}).".format(
-                                    c_id, str(record.id)))
-                except InclusionRequestExistsError:
-                    if logger:
-                        logger.warning("Inclusion request exists.")
+        create_inclusion_requests(
+            [(c_id, record.id) for c_id in communities], logger=logger)
         # Register DOI
-        doi = record.get('doi')
-        if doi:
-            is_internal = doi.startswith('10.5281')
+        if record and record.get('doi'):
             PersistentIdentifier.create(
-                pid_type='doi',
-                pid_value=doi,
-                pid_provider='datacite' if is_internal else None,
-                object_type='rec',
-                object_uuid=record_uuid,
-                status=(
-                    PIDStatus.REGISTERED if is_internal
-                    else PIDStatus.RESERVED),
-            )
+                **_doi_pid_data(record['doi'], record_uuid))
         db.session.commit()
     except NoResultFound:
         if logger:
@@ -94,45 +71,383 @@ def migrate_record(record_uuid, logger=None):
         raise
 
 
-def transform_record(record):
-    """Transform legacy JSON."""
+def migrate_records(record_uuids, logger=None, profiler=None):
+    """Migrate a batch of records, each one in its own savepoint.
+
+    :param record_uuids: UUIDs of the records to migrate.
+    :type record_uuids: list
+    :param profiler: Optional profiler of the transformations.
+    :type profiler: `TransformationProfiler`
+    :returns: Failures (UUID of the record, error, traceback and, for
+        conflicting DOIs, the DOI).
+    :rtype: list
+    """
+    failed, dois, inclusion_requests = [], [], []
+    pipeline = RecordTransformationPipeline(profiler=profiler)
+    for record in iter_records(record_uuids, record_cls=MigrationRecord):
+        try:
+            with db.session.begin_nested():
+                migrated, communities = _migrate_record(
+                    record, pipeline, logger=logger)
+            inclusion_requests.extend(
+                (c_id, record.id) for c_id in communities)
+            if migrated and migrated.get('doi'):
+                dois.append(_doi_pid_data(migrated['doi'], migrated.id))
+        except Exception as e:
+            if logger:
+                logger.exception(
+                    "Failed to migrate record {0}.".format(record.id))
+            failed.append(dict(uuid=str(record.id), error=str(e),
+                               traceback=traceback.format_exc()))
+    create_inclusion_requests(inclusion_requests, logger=logger)
+    if failed:
+        PersistentIdentifier.query.filter(
+            PersistentIdentifier.pid_type == 'recid',
+            PersistentIdentifier.object_type == 'rec',
+            PersistentIdentifier.object_uuid.in_([f['uuid'] for f in failed]),
+        ).update({PersistentIdentifier.status: PIDStatus.RESERVED},
+                 synchronize_session=False)
+    # Records with a conflicting DOI stay migrated, without their DOI.
+    for conflict in create_dois(dois, logger=logger):
+        failed.append(dict(
+            uuid=str(conflict['object_uuid']), doi=conflict['pid_value'],
+            error="DOI {0} already exists.".format(conflict['pid_value']),
+            traceback=None))
+    db.session.commit()
+    return failed
+
+
+def _migrate_record(record, transform, logger=None):
+    """Migrate a record without committing the session.
+
+    Neither the inclusion requests to the provisional communities nor the
+    DOI of the record are created.
+
+    :param transform: Function transforming the legacy record.
+    :returns: The migrated record (``None`` if it was already migrated) and
+        its provisional communities (except the communities which already
+        include the record).
+    :rtype: tuple
+    """
+    if '$schema' in record:
+        if logger:
+            logger.info("Record already migrated.")
+        return None, []
+    record = transform(record)
+    provisional_communities = record.pop('provisional_communities', None)
+    record.commit()
+    communities = record.get('communities', [])
+    obsolete = [c_id for c_id in provisional_communities or []
+                if c_id in communities]
+    if obsolete and logger:
+        logger.warning(
+            "Record {0} is already in communities {1}.".format(
+                str(record.id), ', '.join(obsolete)))
+    return record, [c_id for c_id in provisional_communities or []
+                    if c_id not in communities]
+
+
+class CommunityCache(object):
+    """Per-process cache of the IDs of the existing communities.
+
+    All IDs are loaded with a single query on first use, and reloaded once
+    they are older than ``ttl`` seconds, so that deleted communities are
+    eventually dropped. An ID missing from the cache is looked up in the
+    database (and added to the cache if the community was created in the
+    meantime).
+    """
+
+    def __init__(self, ttl=300):
+        """Initialize the cache.
+
+        :param ttl: Number of seconds after which the IDs are reloaded.
+        :type ttl: float
+        """
+        self.ttl = ttl
+        self._ids = None
+        self._loaded_at = None
+
+    def load(self):
+        """(Re)load the IDs of all existing communities."""
+        self._ids = set(c_id for (c_id,) in db.session.query(
+            Community.id).filter(Community.deleted_at.is_(None)))
+        self._loaded_at = default_timer()
+
+    def clear(self):
+        """Clear the cache (the IDs are loaded again on next use)."""
+        self._ids = None
+        self._loaded_at = None
+
+    def __contains__(self, c_id):
+        """Check if the community exists."""
+        if self._ids is None or \
+                default_timer() - self._loaded_at >= self.ttl:
+            self.load()
+        if c_id not in self._ids and Community.get(c_id) is not None:
+            self._ids.add(c_id)
+        return c_id in self._ids
+
+
+#: Community IDs cache used by the records migration.
+community_cache = CommunityCache()
+
+
+def create_inclusion_requests(requests, logger=None):
+    """Create inclusion requests of records to communities in bulk.
+
+    Requests to communities which do not exist and requests which already
+    exist are logged and skipped. The ``inclusion_request_created`` signal
+    is sent for every created request, without notification.
+
+    :param requests: Pairs of community ID and record UUID.
+    :type requests: list
+    """
+    if not requests:
+        return
+    existing = set(db.session.query(
+        InclusionRequest.id_community, InclusionRequest.id_record).filter(
+            InclusionRequest.id_record.in_(
+                set(record_uuid for _, record_uuid in requests))))
+    created = []
+    for c_id, record_uuid in requests:
+        if c_id not in community_cache:
+            if logger:
+                logger.warning(
+                    "Community {0} does not exists (record {1}).".format(
+                        c_id, str(record_uuid)))
+        elif (c_id, record_uuid) in existing:
+            if logger:
+                logger.warning("Inclusion request exists.")
+        else:
+            existing.add((c_id, record_uuid))
+            created.append(dict(id_community=c_id, id_record=record_uuid))
+    if created:
+        # The cache may be stale (e.g. communities deleted since it was
+        # loaded), hence check the communities again right before inserting.
+        c_ids = set(r['id_community'] for r in created)
+        c_ids = set(c_id for (c_id,) in db.session.query(Community.id).filter(
+            Community.id.in_(c_ids), Community.deleted_at.is_(None)))
+        for r in created:
+            if r['id_community'] not in c_ids and logger:
+                logger.warning(
+                    "Community {0} does not exists (record {1}).".format(
+                        r['id_community'], str(r['id_record'])))
+        created = [r for r in created if r['id_community'] in c_ids]
+    db.session.bulk_insert_mappings(InclusionRequest, created)
+    if created and inclusion_request_created.receivers:
+        created = set((r['id_community'], r['id_record']) for r in created)
+        app = current_app._get_current_object()
+        for request in InclusionRequest.query.filter(
+                InclusionRequest.id_record.in_(
+                    set(record_uuid for _, record_uuid in created))):
+            if (request.id_community, request.id_record) in created:
+                inclusion_request_created.send(
+                    app, request=request, notify=False)
+
+
+def _doi_pid_data(doi, record_uuid):
+    """Get the data of the DOI persistent identifier of a record."""
+    is_internal = doi.startswith('10.5281')
+    return dict(
+        pid_type='doi',
+        pid_value=doi,
+        pid_provider='datacite' if is_internal else None,
+        object_type='rec',
+        object_uuid=record_uuid,
+        status=(
+            PIDStatus.REGISTERED if is_internal
+            else PIDStatus.RESERVED),
+    )
+
+
+def create_dois(dois, logger=None):
+    """Create DOI persistent identifiers with a single bulk insert.
+
+    DOIs which already exist (or are repeated in ``dois``) are not created.
+
+    :param dois: DOI persistent identifiers data (see ``_doi_pid_data``).
+    :type dois: list
+    :returns: Conflicting DOI persistent identifiers data.
+    :rtype: list
+    """
+    if not dois:
+        return []
+    existing = set(pid_value for (pid_value,) in db.session.query(
+        PersistentIdentifier.pid_value).filter(
+            PersistentIdentifier.pid_type == 'doi',
+            PersistentIdentifier.pid_value.in_(
+                [d['pid_value'] for d in dois])))
+    created, conflicts = [], []
+    for data in dois:
+        if data['pid_value'] in existing:
+            conflicts.append(data)
+            if logger:
+                logger.warning("DOI {0} of record {1} already exists.".format(
+                    data['pid_value'], data['object_uuid']))
+        else:
+            existing.add(data['pid_value'])
+            created.append(data)
+    db.session.bulk_insert_mappings(PersistentIdentifier, created)
+    return conflicts
+
+
+def transform_record(record, profiler=None):
+    """Transform legacy JSON.
+
+    :param profiler: Optional profiler of the transformations.
+    :type profiler: `TransformationProfiler`
+    """
     # Record is already migrated.
     if '$schema' in record:
         return record
 
-    transformations = [
-        _remove_fields,
-        _migrate_upload_type,
-        _migrate_authors,
-        _migrate_oai,
-        _migrate_grants,
-        _migrate_license,
-        _migrate_meetings,
-        _migrate_owners,
-        _migrate_description,
-        _migrate_imprint,
-        _migrate_part_of,
-        _migrate_references,
-        _migrate_communities,
-        _migrate_provisional_communities,
-        _migrate_thesis,
-        _add_schema,
-        _add_buckets,
-    ]
-
-    return reduce(lambda record, func: func(record), transformations, record)
+    if profiler is not None:
+        return reduce(lambda record, func: profiler.call(func, record),
+                      RECORD_TRANSFORMATIONS, record)
+    return reduce(lambda record, func: func(record), RECORD_TRANSFORMATIONS,
+                  record)
+
+
+def check_record(record, profiler=None):
+    """Transform and validate a record without storing it.
+
+    :param record: Legacy record.
+    :type record: `invenio_records.api.Record`
+    :param profiler: Optional profiler of the transformations (and of the
+        validation).
+    :type profiler: `TransformationProfiler`
+    :returns: Transformed record and a description of the failure, or
+        ``None`` if the record was successfully transformed and validated.
+    :rtype: tuple
+    """
+    step = None
+    try:
+        if '$schema' not in record:
+            for func in RECORD_TRANSFORMATIONS:
+                step = func.__name__
+                record = profiler.call(func, record) if profiler \
+                    else func(record)
+        step = 'validate'
+        record.pop('provisional_communities', None)
+        if profiler:
+            profiler.call(lambda r: r.validate(), record, name=step)
+        else:
+            record.validate()
+    except Exception as e:
+        failure = {
+            'transformation': step,
+            'error': str(e),
+            'traceback': traceback.format_exc(),
+        }
+        if isinstance(e, ValidationError):
+            failure['path'] = list(e.absolute_path)
+            failure['schema_path'] = list(e.absolute_schema_path)
+        return record, failure
+    return record, None
+
+
+class RecordTransformationPipeline(object):
+    """Record transformations compiled per set of top-level keys.
+
+    Equivalent to ``transform_record`` but the transformations which do not
+    apply to a record (based on its top-level keys) are skipped altogether,
+    and the OAI ``updated`` datestamp is computed once for the pipeline
+    (e.g. once per batch of records).
+    """
+
+    def __init__(self, updated=None, profiler=None):
+        """Initialize the pipeline.
+
+        :param updated: OAI datestamp of the records (default: now).
+        :type updated: str
+        :param profiler: Optional profiler of the transformations.
+        :type profiler: `TransformationProfiler`
+        """
+        self.updated = updated or datetime_to_datestamp(datetime.utcnow())
+        self.profiler = profiler
+        self._pipelines = {}
+
+    def compile(self, keys):
+        """Get the transformations applying to a record with given keys.
+
+        :param keys: Top-level keys of the record.
+        :returns: Pairs of transformation name and function.
+        :rtype: tuple
+        """
+        keys = frozenset(keys) & _TRIGGER_KEYS
+        if keys not in self._pipelines:
+            self._pipelines[keys] = tuple(
+                (func.__name__, partial(func, updated=self.updated)
+                 if func is _migrate_oai else func)
+                for func in RECORD_TRANSFORMATIONS
+                if _TRANSFORMATION_TRIGGERS.get(func) is None or
+                keys & _TRANSFORMATION_TRIGGERS[func])
+        return self._pipelines[keys]
+
+    def __call__(self, record):
+        """Transform legacy JSON."""
+        # Record is already migrated.
+        if '$schema' in record:
+            return record
+
+        for name, func in self.compile(record):
+            if self.profiler is not None:
+                record = self.profiler.call(func, record, name=name)
+            else:
+                record = func(record)
+        return record
+
+
+class TransformationProfiler(object):
+    """Call counts and cumulative wall time of the record transformations."""
+
+    def __init__(self):
+        """Initialize the profiler."""
+        self.stats = {}
+
+    def call(self, func, record, name=None):
+        """Apply a transformation to the record and measure its duration."""
+        start = default_timer()
+        try:
+            return func(record)
+        finally:
+            self.add(name or func.__name__, default_timer() - start)
+
+    def add(self, name, duration, calls=1):
+        """Add the duration of calls of a transformation."""
+        stat = self.stats.setdefault(name, [0, 0.0])
+        stat[0] += calls
+        stat[1] += duration
+
+    def merge(self, stats):
+        """Merge statistics of another profiler (e.g. of a worker process)."""
+        for name, (calls, duration) in stats.items():
+            self.add(name, duration, calls=calls)
+
+    def summary(self):
+        """Format the statistics as a table (slowest transformation first)."""
+        row = '{0:<35} {1:>10} {2:>12} {3:>14}'
+        lines = [row.format('Transformation', 'Calls', 'Total [s]',
+                            'Per call [ms]')]
+        for name, (calls, duration) in sorted(
+                self.stats.items(), key=lambda item: -item[1][1]):
+            lines.append(row.format(
+                name, calls, '{0:.3f}'.format(duration),
+                '{0:.3f}'.format(duration * 1000 / calls)))
+        return '\n'.join(lines)
+
+
+_REMOVED_FIELDS = [
+    'fft', 'files_to_upload', 'files_to_upload', 'collections',
+    'preservation_score', 'restriction', 'url', 'version_history',
+    'documents', 'creation_date', 'modification_date',
+    'system_control_number', 'system_number', 'altmetric_id'
+]
 
 
 def _remove_fields(record):
     """Remove record."""
-    keys = [
-        'fft', 'files_to_upload', 'files_to_upload', 'collections',
-        'preservation_score', 'restriction', 'url', 'version_history',
-        'documents', 'creation_date', 'modification_date',
-        'system_control_number', 'system_number', 'altmetric_id'
-    ]
-
-    for k in keys:
+    for k in _REMOVED_FIELDS:
         if k in record:
             del record[k]
 
@@ -297,7 +612,7 @@ def _migrate_references(record):
     return record
 
 
-def _migrate_oai(record):
+def _migrate_oai(record, updated=None):
     """Transform record OAI information."""
     if 'oai' not in record:
         return record
@@ -312,7 +627,7 @@ def _migrate_oai(record):
     record['_oai'] = {
         'id': oai['oai'],
         'sets': sets,
-        'updated': datetime_to_datestamp(datetime.utcnow()),
+        'updated': updated or datetime_to_datestamp(datetime.utcnow()),
     }
 
     return record
@@ -374,3 +689,47 @@ def _add_buckets(record):
         record['_buckets']['record'] = record['_files'][0]['bucket']
         record['_buckets']['deposit'] = ""
     return record
+
+
+#: Transformations of the legacy records, applied in order.
+RECORD_TRANSFORMATIONS = [
+    _remove_fields,
+    _migrate_upload_type,
+    _migrate_authors,
+    _migrate_oai,
+    _migrate_grants,
+    _migrate_license,
+    _migrate_meetings,
+    _migrate_owners,
+    _migrate_description,
+    _migrate_imprint,
+    _migrate_part_of,
+    _migrate_references,
+    _migrate_communities,
+    _migrate_provisional_communities,
+    _migrate_thesis,
+    _add_schema,
+    _add_buckets,
+]
+
+#: Top-level keys of a record to which the transformations apply (the ones
+#: which are not listed apply to all records). No transformation adds a key
+#: triggering a later one, so the keys of the legacy record are enough to
+#: select the transformations upfront.
+_TRANSFORMATION_TRIGGERS = {
+    _remove_fields: frozenset(_REMOVED_FIELDS),
+    _migrate_oai: frozenset(['oai']),
+    _migrate_grants: frozenset(['grants']),
+    _migrate_license: frozenset(['license']),
+    _migrate_meetings: frozenset(['conference_url', 'meetings']),
+    _migrate_owners: frozenset(['owner']),
+    _migrate_imprint: frozenset(['isbn', 'imprint']),
+    _migrate_part_of: frozenset(['part_of']),
+    _migrate_references: frozenset(['references']),
+    _migrate_communities: frozenset(['communities']),
+    _migrate_provisional_communities: frozenset(['provisional_communities']),
+    _migrate_thesis: frozenset(['thesis_supervisors', 'thesis_university']),
+    _add_buckets: frozenset(['_files']),
+}
+
+_TRIGGER_KEYS = frozenset().union(*_TRANSFORMATION_TRIGGERS.values())
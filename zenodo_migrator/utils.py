@@ -0,0 +1,188 @@
+
+# -*- coding: utf-8 -*-
+#
+# This file is part of Zenodo.
+# Copyright (C) 2017 CERN.
+#
+# Zenodo is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Zenodo is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Zenodo; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+"""Utilities for the migration commands."""
+
+from __future__ import absolute_import, print_function
+
+import json
+import re
+from itertools import islice
+from multiprocessing import Pool
+
+from invenio_records.api import Record
+from invenio_records.models import RecordMetadata
+
+_WHITESPACE = re.compile(r'\s*')
+_NUMBER_TAIL = re.compile(r'[0-9eE.+-]*\Z')
+
+
+def iter_json_array(fp, chunk_size=65536):
+    """Iterate over the elements of a top-level JSON array.
+
+    The file is read and decoded incrementally, one element at a time, so
+    that the memory usage is bounded by the size of the largest element
+    rather than by the size of the whole file.
+
+    :param fp: File-like object containing a JSON array.
+    :param chunk_size: Minimal number of characters read at once.
+    :type chunk_size: int
+    """
+    decoder = json.JSONDecoder()
+    buf = fp.read(chunk_size)
+    pos = 0
+    state = 'start'
+    while True:
+        pos = _WHITESPACE.match(buf, pos).end()
+        if pos == len(buf):
+            chunk = fp.read(chunk_size)
+            if not chunk:
+                raise ValueError('Unexpected end of the JSON array.')
+            buf, pos = buf[pos:] + chunk, 0
+            continue
+
+        char = buf[pos]
+        if state == 'start':
+            if char != '[':
+                raise ValueError('Expected a JSON array.')
+            pos += 1
+            state = 'first'
+        elif state == 'separator':
+            if char == ']':
+                return
+            if char != ',':
+                raise ValueError(
+                    'Expected "," or "]" at position {0}.'.format(pos))
+            pos += 1
+            state = 'element'
+        elif state == 'first' and char == ']':
+            return
+        else:
+            try:
+                element, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                end = None
+            # The element might be incomplete (or a number truncated at the
+            # end of the buffer), in which case read some more data. The read
+            # size grows with the buffer to keep decoding of large elements
+            # linear.
+            if end is None or _NUMBER_TAIL.match(buf, end):
+                chunk = fp.read(max(chunk_size, len(buf) - pos))
+                if chunk:
+                    buf, pos = buf[pos:] + chunk, 0
+                    continue
+                elif end is None:
+                    raise ValueError(
+                        'Invalid JSON array element at position {0}.'.format(
+                            pos))
+            yield element
+            pos = end
+            state = 'separator'
+
+
+def chunks(iterable, size):
+    """Split an iterable into lists of at most ``size`` elements."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def write_failures(fp, failures):
+    """Write migration failures as JSON lines.
+
+    All lines are written at once, so that the failures appended to the same
+    file by concurrent workers are not interleaved.
+
+    :param fp: File-like object opened for (appended) writing.
+    :param failures: Failures (dictionaries serializable as JSON).
+    :type failures: list
+    """
+    if failures:
+        fp.write(''.join(
+            json.dumps(failure, sort_keys=True) + '\n'
+            for failure in failures))
+
+
+def iter_records(uuids, page_size=100, record_cls=Record):
+    """Iterate over records, loading them in pages with one query each.
+
+    The records are yielded in the order of the given UUIDs. Records which
+    do not exist or are deleted are skipped.
+
+    :param uuids: Iterable of record UUIDs.
+    :param page_size: Number of records loaded with a single query.
+    :type page_size: int
+    :param record_cls: Record API class of the yielded records.
+    """
+    for page in chunks(uuids, page_size):
+        models = dict((str(m.id), m) for m in RecordMetadata.query.filter(
+            RecordMetadata.id.in_(page)))
+        for uuid in page:
+            model = models.get(str(uuid))
+            if model is not None and model.json is not None:
+                yield record_cls(model.json, model=model)
+
+
+def parallel_imap(func, iterable, jobs=1, chunksize=10, initializer=None,
+                  initargs=(), pool_cls=Pool):
+    """Apply a function to every element of an iterable in a process pool.
+
+    The results are yielded in the input order. The input is consumed in
+    windows of a few chunks per process (``Pool.imap`` alone would read the
+    whole input upfront), so that the memory usage stays bounded.
+
+    :param func: Picklable function, i.e. defined at module level.
+    :param jobs: Number of worker processes. With a single job, the function
+        is applied in the current process.
+    :type jobs: int
+    :param chunksize: Number of elements sent to a worker at once.
+    :type chunksize: int
+    :param initializer: Function called with ``initargs`` when a worker
+        process starts.
+    :param pool_cls: Class of the pool, e.g.
+        ``multiprocessing.pool.ThreadPool`` for I/O bound functions (which
+        then need not be picklable).
+    """
+    if jobs <= 1:
+        for element in iterable:
+            yield func(element)
+        return
+
+    pool = pool_cls(jobs, initializer=initializer, initargs=initargs)
+    try:
+        for window in chunks(iterable, jobs * chunksize * 4):
+            for result in pool.imap(func, window, chunksize):
+                yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def push_app_context(app):
+    """Push an application context (e.g. in a worker process)."""
+    app.app_context().push()